@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+"""Compare the encode/decode cost of the available JSON codecs
+
+For a representative event of each message type this reports the time to
+encode it to bytes and decode it back with every codec in codec.CODECS
+(the standard library and, if installed, orjson).
+"""
+import argparse
+import timeit
+
+from codec import CODECS
+from bench_formats import sample_events
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=20000,
+                        help="encode/decode repetitions per measurement")
+    parser.add_argument('--history', type=int, default=50,
+                        help="messages in the sample history frame")
+    args = parser.parse_args()
+
+    print(f"{'event':<16} {'codec':<8} {'bytes':>7} {'encode us':>10} {'decode us':>10}")
+    for name, build in sample_events(args.history):
+        frame = build()
+        # The history frame is spliced together, so time its decoded form
+        event = CODECS[0].loads(frame.data)
+        for codec in CODECS:
+            data = codec.dumps(event)
+            encode = timeit.timeit(lambda: codec.dumps(event), number=args.number) / args.number
+            decode = timeit.timeit(lambda: codec.loads(data), number=args.number) / args.number
+            print(f"{name:<16} {codec.name:<8} {len(data):>7} "
+                  f"{encode * 1e6:>10.2f} {decode * 1e6:>10.2f}")
+
+if __name__ == '__main__':
+    main()
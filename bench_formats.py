@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""Compare frame sizes and encode/decode cost of the wire formats
+
+For a representative event of each type this reports the encoded size and
+the time to encode and decode it in every available wire format (JSON and,
+if msgpack is installed, MessagePack). History frames are encoded the way
+the server builds them, by splicing already-encoded messages together.
+"""
+import argparse
+import timeit
+from datetime import datetime
+
+from server import Frame, MessageIdGenerator, WIRE_FORMATS, encode_frame_list
+
+def sample_events(history_size):
+    """Return (name, build) pairs where build() makes a fresh frame"""
+    ids = MessageIdGenerator()
+    timestamp = datetime.now().isoformat()
+
+    def message(index):
+        return {
+            'id': ids.next_id(),
+            'type': 'message',
+            'room': 'general',
+            'username': f"User_{index:06x}",
+            'text': "Lorem ipsum dolor sit amet, consectetur adipiscing elit " * 2,
+            'timestamp': timestamp
+        }
+
+    history = [Frame(message(index)) for index in range(history_size)]
+    events = {
+        'welcome': {'type': 'welcome', 'clientId': '3b241101-e2bb-4255-8caf-4136c566a962',
+                    'username': 'User_3b2411'},
+        'message': message(0),
+        'typing_update': {'type': 'typing_update', 'room': 'general',
+                          'typingUsers': ['User_3b2411', 'User_a1b2c3']},
+        'user_joined': {'id': ids.next_id(), 'type': 'user_joined', 'room': 'general',
+                        'username': 'User_3b2411', 'timestamp': timestamp},
+    }
+    samples = [(name, lambda event=event: Frame(event)) for name, event in events.items()]
+    samples.append((
+        f"history ({history_size})",
+        lambda: Frame.with_raw_field(
+            {'type': 'history', 'room': 'general', 'reset': True, 'hasMore': True},
+            'messages', encode_frame_list(history), history
+        )
+    ))
+    return samples
+
+def measure(build, wire_format, number):
+    """Return (size, encode seconds, decode seconds) for one frame"""
+    data = wire_format.encode(build())
+    encode = timeit.timeit(lambda: wire_format.encode(build()), number=number) / number
+    decode = timeit.timeit(lambda: wire_format.decode(data), number=number) / number
+    return len(data), encode, decode
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=20000,
+                        help="encode/decode repetitions per measurement")
+    parser.add_argument('--history', type=int, default=50,
+                        help="messages in the sample history frame")
+    args = parser.parse_args()
+
+    print(f"{'event':<16} {'format':<18} {'bytes':>7} {'encode us':>10} {'decode us':>10}")
+    for name, build in sample_events(args.history):
+        for subprotocol, wire_format in WIRE_FORMATS.items():
+            size, encode, decode = measure(build, wire_format, args.number)
+            print(f"{name:<16} {subprotocol:<18} {size:>7} {encode * 1e6:>10.2f} {decode * 1e6:>10.2f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""Measure how chat throughput scales with the number of server workers
+
+For each worker count this starts `server.py --workers N`, connects a pool
+of clients spread over several client processes, and has some of them send
+chat messages in a closed loop (each sender waits for its own message to
+come back before sending the next). It reports messages accepted per
+second and frames delivered per second across all clients.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import websockets
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+
+async def run_clients(port, clients, senders, start_at, duration):
+    """Connect `clients` websockets, `senders` of which send messages"""
+    url = f"ws://localhost:{port}/?room=bench"
+    connections = [await websockets.connect(url, max_queue=None) for _ in range(clients)]
+    counts = {'sent': 0, 'delivered': 0}
+    end_at = start_at + duration
+
+    async def receive(websocket, echoes):
+        async for raw in websocket:
+            data = json.loads(raw)
+            events = data['events'] if data.get('type') == 'batch' else (data,)
+            for event in events:
+                if event.get('type') != 'message':
+                    continue
+                if start_at <= time.time() < end_at:
+                    counts['delivered'] += 1
+                if echoes is not None and event['text'] in echoes:
+                    echoes.pop(event['text']).set()
+
+    async def send(websocket, echoes, index):
+        sequence = 0
+        while time.time() < end_at:
+            text = f"{os.getpid()}-{index}-{sequence}"
+            echoed = echoes[text] = asyncio.Event()
+            await websocket.send(json.dumps({'type': 'message', 'text': text}))
+            await echoed.wait()
+            if time.time() >= start_at:
+                counts['sent'] += 1
+            sequence += 1
+
+    tasks = []
+    for index, websocket in enumerate(connections):
+        echoes = {} if index < senders else None
+        tasks.append(asyncio.create_task(receive(websocket, echoes)))
+        if echoes is not None:
+            tasks.append(asyncio.create_task(send(websocket, echoes, index)))
+
+    await asyncio.sleep(max(0, end_at - time.time()) + 0.5)
+    for task in tasks:
+        task.cancel()
+    for websocket in connections:
+        await websocket.close()
+    return counts
+
+def client_process(port, clients, senders, start_at, duration, results):
+    results.put(asyncio.run(run_clients(port, clients, senders, start_at, duration)))
+
+def split_evenly(total, parts):
+    """Split `total` into `parts` counts differing by at most one, larger first"""
+    share, remainder = divmod(total, parts)
+    return [share + (index < remainder) for index in range(parts)]
+
+def wait_for_port(port, timeout=10):
+    """Block until something accepts connections on the port"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('localhost', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"server did not start listening on port {port}")
+
+def run_benchmark(workers, args):
+    """Run one benchmark round against a server with `workers` processes"""
+    server = subprocess.Popen(
+        [sys.executable, SERVER, '--workers', str(workers), '--port', str(args.port),
+         '--batch-window', str(args.batch_window), '--rate-limit', 'message=off'],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        wait_for_port(args.port)
+        time.sleep(0.5)  # let every worker bind before connecting
+
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        start_at = time.time() + 3  # time to open every connection
+        processes = [
+            context.Process(
+                target=client_process,
+                args=(args.port, clients, senders, start_at, args.duration, results)
+            )
+            for clients, senders in zip(split_evenly(args.clients, args.client_procs),
+                                        split_evenly(args.senders, args.client_procs))
+        ]
+        for process in processes:
+            process.start()
+        counts = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+    finally:
+        server.terminate()
+        server.wait()
+
+    sent = sum(count['sent'] for count in counts)
+    delivered = sum(count['delivered'] for count in counts)
+    return sent / args.duration, delivered / args.duration
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4],
+                        help="worker counts to benchmark")
+    parser.add_argument('--clients', type=int, default=200,
+                        help="total number of connected clients")
+    parser.add_argument('--senders', type=int, default=40,
+                        help="how many of the clients send messages")
+    parser.add_argument('--client-procs', type=int, default=4,
+                        help="processes the clients are spread over")
+    parser.add_argument('--duration', type=float, default=10,
+                        help="seconds to measure for each worker count")
+    parser.add_argument('--batch-window', type=float, default=0,
+                        help="server batching window in seconds (0 disables batching)")
+    parser.add_argument('--port', type=int, default=8090)
+    args = parser.parse_args()
+
+    print(f"{'workers':>8} {'messages/s':>12} {'delivered/s':>12}")
+    for workers in args.workers:
+        sent, delivered = run_benchmark(workers, args)
+        print(f"{workers:>8} {sent:>12.0f} {delivered:>12.0f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""JSON codec shared by frames, the event bus and the history store
+
+Uses orjson when it is installed and the standard library otherwise.
+Either way `dumps` returns bytes ready to send and `loads` accepts bytes
+or str.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:  # orjson is optional
+    orjson = None
+
+class StdlibCodec:
+    """JSON codec built on the standard library"""
+
+    name = 'json'
+
+    @staticmethod
+    def dumps(obj):
+        return json.dumps(obj).encode()
+
+    @staticmethod
+    def loads(data):
+        try:
+            return json.loads(data)
+        except RecursionError:
+            # Deeply nested input is as malformed to us as a syntax error
+            raise ValueError("JSON nested too deeply")
+
+# Every codec usable here, fastest last
+CODECS = [StdlibCodec]
+
+if orjson is not None:
+    class OrjsonCodec:
+        """JSON codec built on orjson"""
+
+        name = 'orjson'
+        dumps = staticmethod(orjson.dumps)
+        loads = staticmethod(orjson.loads)
+
+    CODECS.append(OrjsonCodec)
+
+codec = CODECS[-1]
+dumps = codec.dumps
+loads = codec.loads
+
+# What both codecs raise on malformed input, including invalid UTF-8 and
+# (in StdlibCodec, by conversion) nesting too deep to decode
+DecodeError = ValueError
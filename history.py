@@ -0,0 +1,483 @@
+"""Message history storage for the messenger server"""
+import asyncio
+import logging
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+import codec
+
+logger = logging.getLogger(__name__)
+
+# Room that records written without one belong to
+DEFAULT_ROOM = 'general'
+
+# Default caps for the in-memory history
+DEFAULT_MAX_MESSAGES = 1000
+DEFAULT_MAX_BYTES = 1024 * 1024
+
+# Defaults for the on-disk message log
+DEFAULT_SEGMENT_BYTES = 64 * 1024 * 1024
+DEFAULT_FLUSH_INTERVAL = 0.05
+SEGMENT_SUFFIX = '.log'
+READ_BLOCK_SIZE = 64 * 1024
+
+def _take_recent(rows, max_messages, max_bytes, max_rooms):
+    """Pick each room's newest records from (room, record) pairs, newest first
+
+    Keeps up to `max_messages` records and `max_bytes` bytes per room for
+    the first `max_rooms` rooms seen and stops reading once all of them
+    are full. Returns the records oldest first.
+    """
+    records = []
+    # Room name -> [records kept, bytes kept, full]
+    rooms = {}
+    full_rooms = 0
+    for room, record in rows:
+        kept = rooms.get(room)
+        if kept is None:
+            if len(rooms) >= max_rooms:
+                continue
+            kept = rooms[room] = [0, 0, False]
+        if kept[2]:
+            continue
+        if kept[0] >= max_messages or kept[1] + len(record) > max_bytes:
+            kept[2] = True
+            full_rooms += 1
+            if full_rooms == max_rooms:
+                break
+            continue
+        kept[0] += 1
+        kept[1] += len(record)
+        records.append(record)
+    records.reverse()
+    return records
+
+class MessageHistory:
+    """Ring buffer of encoded message frames
+
+    The buffer is preallocated, so appending and evicting the oldest frame
+    are both O(1). It is capped by message count and by the total size of
+    the frames' encoded bytes, whichever limit is hit first.
+    """
+
+    def __init__(self, max_messages=DEFAULT_MAX_MESSAGES, max_bytes=DEFAULT_MAX_BYTES):
+        if max_messages < 1:
+            raise ValueError("max_messages must be at least 1")
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._slots = [None] * max_messages
+        self._head = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        """Iterate from the oldest frame to the newest"""
+        slots = self._slots
+        capacity = self.max_messages
+        for offset in range(self._count):
+            yield slots[(self._head + offset) % capacity]
+
+    def __getitem__(self, index):
+        """Return a frame by position, 0 being the oldest and -1 the newest"""
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("history index out of range")
+        return self._slots[(self._head + index) % self.max_messages]
+
+    def append(self, frame):
+        """Store a frame, evicting the oldest ones to stay within both caps"""
+        if self._count == self.max_messages:
+            self._evict_oldest()
+
+        capacity = self.max_messages
+        position = self._count
+        self._count += 1
+        self.total_bytes += len(frame.data)
+
+        # Frames relayed from other nodes can arrive slightly out of id
+        # order; shift the few newer ones up so the buffer stays sorted
+        slots = self._slots
+        while position > 0:
+            previous = slots[(self._head + position - 1) % capacity]
+            if previous.id <= frame.id:
+                break
+            slots[(self._head + position) % capacity] = previous
+            position -= 1
+        slots[(self._head + position) % capacity] = frame
+
+        # Always keep the newest frame, even if it alone exceeds the budget
+        while self.total_bytes > self.max_bytes and self._count > 1:
+            self._evict_oldest()
+
+    def since(self, message_id):
+        """Return the frames stored after `message_id`, oldest first
+
+        Frame ids increase monotonically, so this is a binary search. Returns
+        None when the id is older than the oldest stored frame or newer than
+        the newest one, since the caller can't tell what it missed.
+        """
+        if not self._count or not self[0].id <= message_id <= self[-1].id:
+            return None
+
+        start = self._bisect(message_id, right=True)
+        return [self[index] for index in range(start, self._count)]
+
+    def before(self, message_id, limit):
+        """Return up to `limit` of the newest frames older than `message_id`"""
+        end = self._bisect(message_id, right=False)
+        return [self[index] for index in range(max(0, end - limit), end)]
+
+    def recent(self, limit):
+        """Return up to `limit` of the newest frames, oldest first"""
+        return [self[index] for index in range(max(0, self._count - limit), self._count)]
+
+    def _bisect(self, message_id, right):
+        """Binary search over frame ids, like bisect.bisect_right or bisect_left"""
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            frame_id = self[middle].id
+            if frame_id < message_id or (right and frame_id == message_id):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def clear(self):
+        """Drop every stored frame"""
+        self._slots = [None] * self.max_messages
+        self._head = 0
+        self._count = 0
+        self.total_bytes = 0
+
+    def _evict_oldest(self):
+        frame = self._slots[self._head]
+        self._slots[self._head] = None
+        self._head = (self._head + 1) % self.max_messages
+        self._count -= 1
+        self.total_bytes -= len(frame.data)
+
+class MessageLog:
+    """Append-only, segmented on-disk log of encoded message frames
+
+    Each record is a frame's JSON bytes followed by a newline. Appends are
+    buffered and written by a background task that fsyncs once per group,
+    so a burst of messages costs one fsync rather than one each; anything
+    appended within the last `flush_interval` seconds can be lost in a
+    crash. A new segment, named after the id of its first record, is
+    started once the current one reaches `segment_bytes`.
+    """
+
+    # Each node keeps its own log, so it also records relayed messages
+    shared = False
+
+    def __init__(self, directory, segment_bytes=DEFAULT_SEGMENT_BYTES,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.flush_interval = flush_interval
+        self._file = None
+        self._pending = []
+        self._pending_ready = None
+        self._flusher = None
+        self._writing = None
+
+    def open(self):
+        """Prepare the log directory, discarding a torn record left by a crash"""
+        os.makedirs(self.directory, exist_ok=True)
+        segments = self._segments()
+        if not segments:
+            return
+
+        path = segments[-1]
+        with open(path, 'rb+') as segment:
+            end = segment.seek(0, os.SEEK_END)
+            valid_end = _last_record_end(segment, end)
+            if valid_end != end:
+                logger.warning(f"Truncating torn record at the end of {path}")
+                segment.truncate(valid_end)
+                os.fsync(segment.fileno())
+
+        if os.path.getsize(path) < self.segment_bytes:
+            self._file = open(path, 'ab')
+
+    async def start(self):
+        """Start the background group-commit task"""
+        self._pending_ready = asyncio.Event()
+        self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        """Write anything still pending and close the current segment"""
+        if self._flusher:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        if self._writing:
+            # A write the flusher started keeps running in its thread
+            try:
+                await self._writing
+            except Exception as e:
+                logger.error(f"Error writing message log: {e}")
+            self._writing = None
+
+        batch, self._pending = self._pending, []
+        if batch:
+            await asyncio.to_thread(self._write_batch, batch)
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def append(self, frame):
+        """Queue a frame to be written with the next group commit"""
+        self._pending.append((frame.id, frame.data))
+        if self._pending_ready:
+            self._pending_ready.set()
+
+    def load_recent(self, max_messages, max_bytes, max_rooms):
+        """Return the newest records of each of the most recent rooms, oldest first
+
+        Every room gets up to `max_messages` records and `max_bytes` bytes.
+        Segments are read backwards from their end until `max_rooms` rooms
+        are full, so with fewer rooms than that the whole log is read.
+        """
+        return _take_recent(self._rooms_and_records(), max_messages, max_bytes, max_rooms)
+
+    def _rooms_and_records(self):
+        """Yield (room, record) for every record, newest first"""
+        for path in reversed(self._segments()):
+            for record in _read_records_backwards(path):
+                try:
+                    room = codec.loads(record).get('room', DEFAULT_ROOM)
+                except codec.DecodeError:
+                    logger.warning(f"Skipping unreadable record in {path}")
+                    continue
+                yield room, record
+
+    async def load_before(self, room, message_id, limit):
+        """Return up to `limit` of a room's newest records older than `message_id`"""
+        return await asyncio.to_thread(self._load_before, room, message_id, limit)
+
+    def _load_before(self, room, message_id, limit):
+        records = []
+        for path in reversed(self._segments()):
+            # A segment's name is the id of its first record
+            if _segment_first_id(path) >= message_id:
+                continue
+            for record in _read_records_backwards(path):
+                event = codec.loads(record)
+                if event['id'] >= message_id or event.get('room', DEFAULT_ROOM) != room:
+                    continue
+                records.append(record)
+                if len(records) >= limit:
+                    records.reverse()
+                    return records
+        records.reverse()
+        return records
+
+    async def _flush_loop(self):
+        """Write and fsync pending records in groups"""
+        while True:
+            await self._pending_ready.wait()
+            # Let the rest of the group arrive before paying for the fsync
+            await asyncio.sleep(self.flush_interval)
+            self._pending_ready.clear()
+            batch, self._pending = self._pending, []
+            self._writing = asyncio.ensure_future(asyncio.to_thread(self._write_batch, batch))
+            try:
+                # Shielded so that close() can wait for the write to finish
+                await asyncio.shield(self._writing)
+            except Exception as e:
+                logger.error(f"Error writing message log: {e}")
+            self._writing = None
+
+    def _write_batch(self, batch):
+        """Write a group of records and fsync once, rolling segments as needed"""
+        for frame_id, data in batch:
+            if self._file is None or self._file.tell() >= self.segment_bytes:
+                self._roll(frame_id)
+            self._file.write(data + b'\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _roll(self, first_id):
+        """Close the current segment and start a new one at `first_id`"""
+        if self._file:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+        path = os.path.join(self.directory, f"{first_id:020d}{SEGMENT_SUFFIX}")
+        self._file = open(path, 'ab')
+        logger.info(f"Started message log segment {path}")
+
+    def _segments(self):
+        """Return segment paths, oldest first"""
+        # Zero-padded ids make lexical order match numeric order
+        names = sorted(
+            name for name in os.listdir(self.directory) if name.endswith(SEGMENT_SUFFIX)
+        )
+        return [os.path.join(self.directory, name) for name in names]
+
+def _segment_first_id(path):
+    return int(os.path.basename(path)[:-len(SEGMENT_SUFFIX)])
+
+def _last_record_end(segment, end):
+    """Return the offset just past the last complete record in a segment"""
+    position = end
+    while position > 0:
+        size = min(READ_BLOCK_SIZE, position)
+        position -= size
+        segment.seek(position)
+        newline = segment.read(size).rfind(b'\n')
+        if newline != -1:
+            return position + newline + 1
+    return 0
+
+def _read_records_backwards(path):
+    """Yield a segment's complete records from the newest to the oldest"""
+    with open(path, 'rb') as segment:
+        position = segment.seek(0, os.SEEK_END)
+        remainder = b''
+        found_end = False
+        while position > 0:
+            size = min(READ_BLOCK_SIZE, position)
+            position -= size
+            segment.seek(position)
+            chunk = segment.read(size) + remainder
+            if not found_end:
+                # Whatever follows the last newline is a torn write, not a record
+                end = chunk.rfind(b'\n')
+                if end == -1:
+                    remainder = b''
+                    continue
+                chunk = chunk[:end]
+                found_end = True
+            lines = chunk.split(b'\n')
+            remainder = lines[0]
+            for line in reversed(lines[1:]):
+                if line:
+                    yield line
+        if found_end and remainder:
+            yield remainder
+
+class SQLiteHistory:
+    """Message history stored in a SQLite database
+
+    Appends are collected on the event loop and written in batches, one
+    transaction per batch, on a single worker thread that owns the
+    connection, so neither writes nor page loads block the loop.
+    """
+
+    def __init__(self, path, flush_interval=DEFAULT_FLUSH_INTERVAL, shared=True):
+        self.path = path
+        self.flush_interval = flush_interval
+        # Whether every node writes to this same database; nodes on other
+        # hosts have their own, so they also record relayed messages
+        self.shared = shared
+        self._db = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-history')
+        self._pending = []
+        self._pending_ready = None
+        self._flusher = None
+
+    def open(self):
+        """Open the database and create the schema if needed"""
+        # Other worker processes may hold the write lock briefly
+        self._db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS messages ('
+            'id INTEGER PRIMARY KEY, '
+            'data BLOB NOT NULL)'
+        )
+        # Databases created before rooms existed have no room column
+        columns = [row[1] for row in self._db.execute('PRAGMA table_info(messages)')]
+        if 'room' not in columns:
+            self._db.execute(
+                f"ALTER TABLE messages ADD COLUMN room TEXT NOT NULL DEFAULT '{DEFAULT_ROOM}'"
+            )
+        self._db.execute('CREATE INDEX IF NOT EXISTS messages_room_id ON messages (room, id)')
+        self._db.commit()
+
+    async def start(self):
+        """Start the background batch writer"""
+        self._pending_ready = asyncio.Event()
+        self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        """Write anything still pending and close the database"""
+        if self._flusher:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+
+        batch, self._pending = self._pending, []
+        loop = asyncio.get_running_loop()
+        if batch:
+            await loop.run_in_executor(self._executor, self._write_batch, batch)
+        await loop.run_in_executor(self._executor, self._db.close)
+        self._executor.shutdown()
+
+    def append(self, frame):
+        """Queue a frame to be written with the next batch"""
+        self._pending.append((frame.id, frame.event.get('room', DEFAULT_ROOM), frame.data))
+        if self._pending_ready:
+            self._pending_ready.set()
+
+    def load_recent(self, max_messages, max_bytes, max_rooms):
+        """Return the newest records of each of the most recent rooms, oldest first"""
+        rows = self._db.execute(
+            'SELECT room, data FROM ('
+            'SELECT room, data, id, '
+            'ROW_NUMBER() OVER (PARTITION BY room ORDER BY id DESC) AS position '
+            'FROM messages) '
+            'WHERE position <= ? ORDER BY id DESC',
+            (max_messages,)
+        )
+        return _take_recent(
+            ((room, bytes(data)) for room, data in rows), max_messages, max_bytes, max_rooms
+        )
+
+    async def load_before(self, room, message_id, limit):
+        """Return up to `limit` of a room's newest records older than `message_id`"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, self._load_before, room, message_id, limit
+        )
+
+    def _load_before(self, room, message_id, limit):
+        rows = self._db.execute(
+            'SELECT data FROM messages WHERE room = ? AND id < ? ORDER BY id DESC LIMIT ?',
+            (room, message_id, limit)
+        ).fetchall()
+        return [bytes(data) for (data,) in reversed(rows)]
+
+    async def _flush_loop(self):
+        """Write pending records in batches"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._pending_ready.wait()
+            await asyncio.sleep(self.flush_interval)
+            self._pending_ready.clear()
+            batch, self._pending = self._pending, []
+            try:
+                await loop.run_in_executor(self._executor, self._write_batch, batch)
+            except sqlite3.Error as e:
+                logger.error(f"Error writing message history: {e}")
+
+    def _write_batch(self, batch):
+        with self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO messages (id, room, data) VALUES (?, ?, ?)', batch
+            )
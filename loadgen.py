@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""Drive a messenger server with simulated clients and report latency
+
+Starts `server.py` (or targets one already running with --url), connects N
+clients spread over several client processes, and has every client send a
+configurable mix of message, typing_start, typing_stop and username_change
+events at a fixed rate. Chat messages carry their send time, so every
+client that receives one records its end-to-end delivery latency.
+
+Reports p50/p99/p999 delivery latency, messages sent and frames delivered
+per second, and the server's CPU use and peak RSS (read from /proc, so
+Linux only).
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import time
+
+import websockets
+
+from bench_workers import SERVER, split_evenly, wait_for_port
+
+CLIENT_TYPES = ('message', 'typing_start', 'typing_stop', 'username_change')
+
+def parse_mix(value):
+    """Parse TYPE=WEIGHT,... into (types, weights)"""
+    types, weights = [], []
+    for part in value.split(','):
+        message_type, _, weight = part.partition('=')
+        if message_type not in CLIENT_TYPES:
+            raise argparse.ArgumentTypeError(f"unknown message type {message_type!r}")
+        try:
+            weights.append(float(weight))
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"invalid weight in {part!r}")
+        types.append(message_type)
+    return types, weights
+
+async def run_clients(url, clients, rate, mix, start_at, duration, seed):
+    """Connect `clients` websockets that each send `rate` events per second"""
+    connections = [await websockets.connect(url, max_queue=None) for _ in range(clients)]
+    rng = random.Random(seed)
+    types, weights = mix
+    end_at = start_at + duration
+    result = {'sent': 0, 'delivered': 0, 'latencies': []}
+
+    async def receive(websocket):
+        async for raw in websocket:
+            data = json.loads(raw)
+            events = data['events'] if data.get('type') == 'batch' else (data,)
+            now = time.time()
+            if not start_at <= now < end_at:
+                continue
+            for event in events:
+                if event.get('type') != 'message':
+                    continue
+                result['delivered'] += 1
+                try:
+                    sent_at = float(event['text'].partition(' ')[0])
+                except ValueError:
+                    continue  # Not sent by the load generator
+                result['latencies'].append(now - sent_at)
+
+    async def send(websocket, index):
+        # Spread the clients' send times over the interval
+        await asyncio.sleep(rng.random() / rate)
+        renames = 0
+        next_at = time.time()
+        while next_at < end_at:
+            message_type = rng.choices(types, weights)[0]
+            if message_type == 'message':
+                event = {'type': 'message', 'text': f"{time.time()!r} load test"}
+            elif message_type == 'username_change':
+                renames += 1
+                event = {'type': 'username_change', 'username': f"load-{seed}-{index}-{renames}"}
+            else:
+                event = {'type': message_type}
+            await websocket.send(json.dumps(event))
+            if message_type == 'message' and time.time() >= start_at:
+                result['sent'] += 1
+            next_at += 1 / rate
+            await asyncio.sleep(max(0, next_at - time.time()))
+
+    tasks = []
+    for index, websocket in enumerate(connections):
+        tasks.append(asyncio.create_task(receive(websocket)))
+        tasks.append(asyncio.create_task(send(websocket, index)))
+
+    await asyncio.sleep(max(0, end_at - time.time()) + 0.5)
+    for task in tasks:
+        task.cancel()
+    for websocket in connections:
+        await websocket.close()
+    return result
+
+def client_process(url, clients, rate, mix, start_at, duration, seed, results):
+    results.put(asyncio.run(run_clients(url, clients, rate, mix, start_at, duration, seed)))
+
+def process_tree(pid):
+    """Return the pid and the pids of its direct children"""
+    pids = [pid]
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # The parent pid is the second field after the command name
+                fields = f.read().rpartition(')')[2].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            pids.append(int(entry))
+    return pids
+
+def sample_usage(pid):
+    """Return (CPU seconds, RSS bytes) summed over a process and its children"""
+    ticks = os.sysconf('SC_CLK_TCK')
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    cpu = rss = 0
+    for child in process_tree(pid):
+        try:
+            with open(f"/proc/{child}/stat") as f:
+                fields = f.read().rpartition(')')[2].split()
+        except OSError:
+            continue
+        # utime and stime are fields 14 and 15, rss is field 24
+        cpu += (int(fields[11]) + int(fields[12])) / ticks
+        rss += int(fields[21]) * page_size
+    return cpu, rss
+
+def percentile(values, fraction):
+    """Return the value below which `fraction` of the sorted values fall"""
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def start_server(args):
+    """Start server.py with rate limits lifted for the simulated clients"""
+    command = [sys.executable, SERVER, '--port', str(args.port), '--workers', str(args.workers)]
+    for message_type in CLIENT_TYPES:
+        command += ['--rate-limit', f"{message_type}=off"]
+    command += args.server_arg
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for_port(args.port)
+    time.sleep(0.5)  # let every worker bind before connecting
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=200,
+                        help="number of simulated clients")
+    parser.add_argument('--rate', type=float, default=1.0,
+                        help="events each client sends per second")
+    parser.add_argument('--mix', type=parse_mix,
+                        default=parse_mix('message=60,typing_start=25,typing_stop=10,username_change=5'),
+                        help="relative weights of the event types sent, as TYPE=WEIGHT,...")
+    parser.add_argument('--duration', type=float, default=10,
+                        help="seconds to measure for")
+    parser.add_argument('--client-procs', type=int, default=4,
+                        help="processes the clients are spread over")
+    parser.add_argument('--room', default='loadtest',
+                        help="room every client joins")
+    parser.add_argument('--port', type=int, default=8091)
+    parser.add_argument('--workers', type=int, default=1,
+                        help="server worker processes")
+    parser.add_argument('--server-arg', action='append', default=[],
+                        help="extra argument passed to server.py; may be repeated")
+    parser.add_argument('--url',
+                        help="websocket URL of a server that is already running")
+    parser.add_argument('--server-pid', type=int,
+                        help="pid of the server given with --url, for CPU and RSS figures")
+    args = parser.parse_args()
+
+    server = None
+    server_pid = args.server_pid
+    url = args.url
+    if url is None:
+        server = start_server(args)
+        server_pid = server.pid
+        url = f"ws://localhost:{args.port}/?room={args.room}"
+
+    try:
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        start_at = time.time() + 3  # time to open every connection
+        processes = [
+            context.Process(
+                target=client_process,
+                args=(url, clients, args.rate, args.mix, start_at, args.duration, seed, results)
+            )
+            for seed, clients in enumerate(split_evenly(args.clients, args.client_procs))
+        ]
+        for process in processes:
+            process.start()
+
+        # Sample the server while the clients run
+        cpu_start = cpu_end = None
+        peak_rss = 0
+        end_at = start_at + args.duration
+        while time.time() < end_at + 0.2:
+            if server_pid is not None:
+                cpu, rss = sample_usage(server_pid)
+                peak_rss = max(peak_rss, rss)
+                if cpu_start is None and time.time() >= start_at:
+                    cpu_start = cpu
+                if time.time() < end_at:
+                    cpu_end = cpu
+            time.sleep(0.25)
+
+        counts = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    latencies = sorted(latency for count in counts for latency in count['latencies'])
+    sent = sum(count['sent'] for count in counts)
+    delivered = sum(count['delivered'] for count in counts)
+    print(f"clients:       {args.clients} at {args.rate:g} events/s each")
+    print(f"messages/s:    {sent / args.duration:.0f} sent, {delivered / args.duration:.0f} delivered")
+    print(f"latency (ms):  p50 {percentile(latencies, 0.5) * 1000:.2f}  "
+          f"p99 {percentile(latencies, 0.99) * 1000:.2f}  "
+          f"p999 {percentile(latencies, 0.999) * 1000:.2f}")
+    if cpu_start is not None and cpu_end is not None:
+        print(f"server CPU:    {(cpu_end - cpu_start) / args.duration * 100:.0f}% of one core")
+        print(f"server RSS:    {peak_rss / 2**20:.1f} MiB peak")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+"""Counters for the messenger server and their Prometheus text exposition
+
+Everything here is updated on the hot path, so recording is a couple of
+integer or dict updates; formatting only happens when /metrics is scraped.
+"""
+import logging
+import time
+from bisect import bisect_left
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the broadcast fan-out duration buckets
+FANOUT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1)
+
+class Histogram:
+    """Counts of observations falling into fixed buckets"""
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # The last slot counts observations above every bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class TrafficCounter:
+    """Frames and bytes by message type"""
+
+    __slots__ = ('frames', 'bytes')
+
+    def __init__(self):
+        self.frames = {}
+        self.bytes = {}
+
+    def add(self, message_type, size):
+        self.frames[message_type] = self.frames.get(message_type, 0) + 1
+        self.bytes[message_type] = self.bytes.get(message_type, 0) + size
+
+class ServerMetrics:
+    """Counters shared by the server and every client's outbox"""
+
+    def __init__(self):
+        self.inbound = TrafficCounter()
+        self.outbound = TrafficCounter()
+        self.send_failures = 0
+        self.dropped_frames = 0
+        self.slow_consumer_disconnects = 0
+        self.rate_limit_disconnects = 0
+
+class RollingPercentiles:
+    """The last `size` observations, kept for percentile queries"""
+
+    __slots__ = ('values', 'index', 'count', 'sum')
+
+    def __init__(self, size):
+        self.values = [0.0] * size
+        self.index = 0
+        self.count = 0
+        self.sum = 0.0
+
+    def add(self, value):
+        self.values[self.index] = value
+        self.index = (self.index + 1) % len(self.values)
+        self.count += 1
+        self.sum += value
+
+    def percentiles(self, fractions):
+        """Return the value at each fraction of the window, or None if it's empty"""
+        window = sorted(self.values[:min(self.count, len(self.values))])
+        if not window:
+            return [None] * len(fractions)
+        return [window[min(len(window) - 1, int(fraction * len(window)))] for fraction in fractions]
+
+class HandlerTimings:
+    """Times wrapped handlers and logs the invocations slower than a threshold
+
+    Handlers are wrapped when they are registered, so a server with timing
+    disabled calls them directly and pays nothing. The recipient count
+    logged for a slow call is the number of frames broadcast while it ran,
+    which includes other tasks' broadcasts if the handler awaited.
+    """
+
+    def __init__(self, slow_threshold=0.05, window=1024):
+        self.slow_threshold = slow_threshold
+        self.window = window
+        self.stats = {}
+
+    def wrap(self, name, handler, recipients):
+        """Return `handler` timed under `name`; `recipients()` counts frames broadcast so far"""
+        stats = self.stats.setdefault(name, RollingPercentiles(self.window))
+        threshold = self.slow_threshold
+
+        async def timed(*args):
+            sent_before = recipients()
+            started = time.perf_counter()
+            try:
+                return await handler(*args)
+            finally:
+                elapsed = time.perf_counter() - started
+                stats.add(elapsed)
+                if elapsed >= threshold:
+                    logger.warning(
+                        f"Slow {name}: {elapsed * 1000:.1f} ms, "
+                        f"{recipients() - sent_before} recipients"
+                    )
+
+        return timed
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels.items()) + '}'
+
+class MetricsWriter:
+    """Builds a Prometheus text exposition, adding `labels` to every sample"""
+
+    def __init__(self, labels=None):
+        self.labels = labels or {}
+        self.lines = []
+
+    def _family(self, name, kind, help_text):
+        self.lines.append(f"# HELP {name} {help_text}")
+        self.lines.append(f"# TYPE {name} {kind}")
+
+    def _sample(self, name, value, labels=None):
+        self.lines.append(f"{name}{format_labels({**self.labels, **(labels or {})})} {value}")
+
+    def gauge(self, name, help_text, value):
+        self._family(name, 'gauge', help_text)
+        self._sample(name, value)
+
+    def counter(self, name, help_text, value):
+        self._family(name, 'counter', help_text)
+        self._sample(name, value)
+
+    def labeled_counter(self, name, help_text, label, values):
+        """Write a counter with one sample per `label` value"""
+        self._family(name, 'counter', help_text)
+        for key, value in sorted(values.items()):
+            self._sample(name, value, {label: key})
+
+    def histogram(self, name, help_text, histogram):
+        self._family(name, 'histogram', help_text)
+        cumulative = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            cumulative += count
+            self._sample(f"{name}_bucket", cumulative, {'le': repr(bound)})
+        self._sample(f"{name}_bucket", histogram.count, {'le': '+Inf'})
+        self._sample(f"{name}_sum", histogram.sum)
+        self._sample(f"{name}_count", histogram.count)
+
+    def summary(self, name, help_text, label, stats, quantiles=(0.5, 0.9, 0.99)):
+        """Write rolling percentiles with one set of quantiles per `label` value"""
+        self._family(name, 'summary', help_text)
+        for key, rolling in sorted(stats.items()):
+            for quantile, value in zip(quantiles, rolling.percentiles(quantiles)):
+                if value is not None:
+                    self._sample(name, value, {label: key, 'quantile': repr(quantile)})
+            self._sample(f"{name}_sum", rolling.sum, {label: key})
+            self._sample(f"{name}_count", rolling.count, {label: key})
+
+    def text(self):
+        return '\n'.join(self.lines) + '\n'
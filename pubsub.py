@@ -0,0 +1,319 @@
+"""Pub/sub backends that share events between messenger server nodes"""
+import asyncio
+import logging
+import os
+import struct
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+# Redis channel every node publishes to and subscribes on
+DEFAULT_REDIS_CHANNEL = 'messenger:events'
+REDIS_RECONNECT_DELAY = 1.0
+
+# Every bus message is a 4-byte big-endian length followed by the payload
+HEADER = struct.Struct('>I')
+
+def encode_event(node_id, data):
+    """Wrap an encoded frame with the id of the node that published it"""
+    return node_id.encode() + b'\n' + data
+
+def decode_event(payload):
+    """Split a bus payload into the publishing node's id and the frame bytes"""
+    node_id, _, data = payload.partition(b'\n')
+    return node_id.decode(), data
+
+async def read_message(reader):
+    """Read one length-prefixed message, raising IncompleteReadError at EOF"""
+    header = await reader.readexactly(HEADER.size)
+    (length,) = HEADER.unpack(header)
+    return await reader.readexactly(length)
+
+class PubSubBackend:
+    """Interface for sharing events between server nodes
+
+    Events are encoded frames. A backend calls `on_event(node_id, data)`
+    for every event published by another node and never for the events
+    its own node published.
+    """
+
+    def __init__(self, node_id):
+        self.node_id = node_id
+
+    async def start(self, on_event):
+        """Start delivering other nodes' events to `on_event`"""
+        raise NotImplementedError
+
+    def publish(self, data):
+        """Send an encoded frame to every other node without waiting"""
+        raise NotImplementedError
+
+    async def close(self):
+        """Stop sharing events"""
+
+class InProcessBackend(PubSubBackend):
+    """Backend for nodes living in the same process
+
+    On its own this is the single-node behaviour: there is nobody else to
+    tell, so publishing does nothing. Backends sharing a `peers` list
+    deliver to each other on the event loop.
+    """
+
+    def __init__(self, node_id, peers=None):
+        super().__init__(node_id)
+        self.peers = peers if peers is not None else []
+        self._on_event = None
+        # Deliveries in flight, referenced so they aren't garbage collected
+        self._deliveries = set()
+
+    async def start(self, on_event):
+        self._on_event = on_event
+        self.peers.append(self)
+
+    def publish(self, data):
+        for peer in self.peers:
+            if peer is not self:
+                delivery = asyncio.create_task(peer._deliver(self.node_id, data))
+                peer._deliveries.add(delivery)
+                delivery.add_done_callback(peer._deliveries.discard)
+
+    async def close(self):
+        if self in self.peers:
+            self.peers.remove(self)
+        await asyncio.gather(*self._deliveries, return_exceptions=True)
+
+    async def _deliver(self, node_id, data):
+        try:
+            await self._on_event(node_id, data)
+        except Exception as e:
+            logger.error(f"Error handling bus event: {e}")
+
+class BusHub:
+    """Unix socket server relaying each worker's events to every other worker
+
+    The hub runs in the launcher process. It never parses payloads and
+    never sends a message back to the connection it came from.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.writers = set()
+        self._server = None
+        self._handlers = set()
+
+    async def start(self):
+        """Listen on the Unix socket, replacing a stale one left behind"""
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._handle_worker, self.path)
+
+    async def close(self):
+        """Stop listening and disconnect every worker"""
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+        for writer in list(self.writers):
+            writer.close()
+        await asyncio.gather(*self._handlers, return_exceptions=True)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    async def _handle_worker(self, reader, writer):
+        handler = asyncio.current_task()
+        self.writers.add(writer)
+        self._handlers.add(handler)
+        try:
+            while True:
+                payload = await read_message(reader)
+                message = HEADER.pack(len(payload)) + payload
+                for other in self.writers:
+                    if other is not writer:
+                        other.write(message)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.writers.discard(writer)
+            self._handlers.discard(handler)
+            writer.close()
+
+class UnixSocketBus(PubSubBackend):
+    """Worker side of the local event bus served by BusHub"""
+
+    def __init__(self, path, node_id):
+        super().__init__(node_id)
+        self.path = path
+        self._writer = None
+        self._reader_task = None
+
+    async def start(self, on_event):
+        reader, self._writer = await asyncio.open_unix_connection(self.path)
+        self._reader_task = asyncio.create_task(self._read_loop(reader, on_event))
+
+    async def close(self):
+        if self._reader_task:
+            self._reader_task.cancel()
+        if self._writer:
+            self._writer.close()
+
+    def publish(self, data):
+        payload = encode_event(self.node_id, data)
+        self._writer.write(HEADER.pack(len(payload)) + payload)
+
+    async def _read_loop(self, reader, on_event):
+        try:
+            while True:
+                node_id, data = decode_event(await read_message(reader))
+                try:
+                    await on_event(node_id, data)
+                except Exception as e:
+                    logger.error(f"Error handling bus event: {e}")
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.error("Lost connection to the event bus")
+
+class RedisError(Exception):
+    """Error reply from a Redis server"""
+
+def encode_command(*args):
+    """Encode a command as a RESP array of bulk strings"""
+    parts = [b'*%d\r\n' % len(args)]
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode()
+        parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+    return b''.join(parts)
+
+async def read_reply(reader):
+    """Read one RESP reply"""
+    line = await reader.readline()
+    if not line.endswith(b'\r\n'):
+        raise ConnectionError("connection closed by Redis server")
+    prefix, body = line[:1], line[1:-2]
+    if prefix == b'+':
+        return body.decode()
+    if prefix == b'-':
+        raise RedisError(body.decode())
+    if prefix == b':':
+        return int(body)
+    if prefix == b'$':
+        length = int(body)
+        if length < 0:
+            return None
+        return (await reader.readexactly(length + 2))[:-2]
+    if prefix == b'*':
+        length = int(body)
+        if length < 0:
+            return None
+        return [await read_reply(reader) for _ in range(length)]
+    raise RedisError(f"unexpected reply type {prefix!r}")
+
+class RedisBackend(PubSubBackend):
+    """Shares events between nodes through Redis PUBLISH/SUBSCRIBE
+
+    Speaks the RESP protocol directly over two connections, since a
+    subscribed connection can't publish. Each event carries the publishing
+    node's id and a random token of the publishing process, so a node skips
+    its own events when Redis echoes them back even if another node was
+    started with the same id. Both connections reconnect after a failure;
+    events published while disconnected are dropped.
+    """
+
+    def __init__(self, url, node_id, channel=DEFAULT_REDIS_CHANNEL):
+        super().__init__(node_id)
+        parts = urlsplit(url)
+        self.host = parts.hostname or 'localhost'
+        self.port = parts.port or 6379
+        self.password = parts.password
+        self.channel = channel
+        self.instance = os.urandom(8).hex()
+        self._publisher = None
+        self._tasks = []
+        self._clashing = set()
+
+    async def start(self, on_event):
+        # Fail fast if Redis isn't reachable at startup
+        await self._connect_publisher()
+        subscribed = asyncio.get_running_loop().create_future()
+        self._tasks.append(asyncio.create_task(self._subscribe_loop(on_event, subscribed)))
+        await subscribed
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._publisher:
+            self._publisher.close()
+
+    def publish(self, data):
+        if self._publisher is None or self._publisher.is_closing():
+            logger.warning("Dropping event published while Redis is disconnected")
+            return
+        self._publisher.write(
+            encode_command('PUBLISH', self.channel,
+                           encode_event(f"{self.instance} {self.node_id}", data))
+        )
+
+    async def _open(self):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            writer.write(encode_command('AUTH', self.password))
+            await read_reply(reader)
+        return reader, writer
+
+    async def _connect_publisher(self):
+        reader, self._publisher = await self._open()
+        self._tasks.append(asyncio.create_task(self._drain_replies(reader)))
+
+    async def _drain_replies(self, reader):
+        """Discard PUBLISH replies, reconnecting if the connection drops"""
+        while True:
+            try:
+                while True:
+                    await read_reply(reader)
+            except (ConnectionError, asyncio.IncompleteReadError, RedisError) as e:
+                logger.error(f"Lost Redis publisher connection: {e}")
+            self._publisher.close()
+            while True:
+                await asyncio.sleep(REDIS_RECONNECT_DELAY)
+                try:
+                    reader, self._publisher = await self._open()
+                    break
+                except (OSError, RedisError) as e:
+                    logger.error(f"Error reconnecting to Redis: {e}")
+
+    async def _subscribe_loop(self, on_event, subscribed):
+        """Subscribe to the channel and deliver other nodes' events"""
+        while True:
+            writer = None
+            try:
+                reader, writer = await self._open()
+                writer.write(encode_command('SUBSCRIBE', self.channel))
+                await read_reply(reader)
+                if not subscribed.done():
+                    subscribed.set_result(None)
+                while True:
+                    reply = await read_reply(reader)
+                    if reply[0] != b'message':
+                        continue
+                    sender, data = decode_event(reply[2])
+                    instance, _, node_id = sender.partition(' ')
+                    if instance == self.instance:
+                        continue
+                    if node_id == self.node_id and instance not in self._clashing:
+                        self._clashing.add(instance)
+                        logger.warning(
+                            f"Another server is using node id {node_id}; message ids can "
+                            f"collide, give every node a unique --node"
+                        )
+                    try:
+                        await on_event(node_id, data)
+                    except Exception as e:
+                        logger.error(f"Error handling pub/sub event: {e}")
+            except (OSError, asyncio.IncompleteReadError, RedisError) as e:
+                if not subscribed.done():
+                    subscribed.set_exception(e)
+                    return
+                logger.error(f"Lost Redis subscriber connection: {e}")
+            finally:
+                if writer is not None:
+                    writer.close()
+            await asyncio.sleep(REDIS_RECONNECT_DELAY)
@@ -1,53 +1,949 @@
 #!/usr/bin/env python3
+import argparse
 import asyncio
+import multiprocessing
+import os
+import signal
+import tempfile
 import websockets
-import json
 import uuid
+import time
+import heapq
+from collections import deque
 from datetime import datetime
+from http import HTTPStatus
+from urllib.parse import parse_qs, urlsplit
 import logging
 
+try:
+    import msgpack
+except ImportError:  # The binary wire format is optional
+    msgpack = None
+
+import codec
+from metrics import FANOUT_BUCKETS, HandlerTimings, Histogram, MetricsWriter, ServerMetrics
+from static import StaticFile
+from pubsub import BusHub, InProcessBackend, RedisBackend, UnixSocketBus, DEFAULT_REDIS_CHANNEL
+from history import (
+    MessageHistory, MessageLog, SQLiteHistory, DEFAULT_ROOM, DEFAULT_MAX_MESSAGES,
+    DEFAULT_MAX_BYTES, DEFAULT_SEGMENT_BYTES, DEFAULT_FLUSH_INTERVAL
+)
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-class MessengerServer:
+# Close code sent to clients that can't keep up with their outbound queue
+SLOW_CONSUMER_CLOSE_CODE = 4008
+# Close code sent to clients that keep sending faster than their rate limits
+RATE_LIMIT_CLOSE_CODE = 4029
+
+# Per-connection (rate per second, burst) for each client message type;
+# types not listed aren't limited. 'invalid' covers frames that don't
+# decode to an object with a known type
+DEFAULT_RATE_LIMITS = {
+    'message': (5, 10),
+    'typing_start': (2, 5),
+    'typing_stop': (2, 5),
+    'username_change': (0.2, 3),
+    'load_older': (2, 5),
+    'join_room': (2, 10),
+    'leave_room': (2, 10),
+    'switch_room': (2, 10),
+    'invalid': (1, 5),
+}
+
+# Limits on the rooms clients can create by joining them
+MAX_ROOM_NAME_LENGTH = 64
+DEFAULT_MAX_ROOMS = 1000
+DEFAULT_MAX_ROOMS_PER_CLIENT = 20
+
+# Limits on what clients send; larger websocket messages are refused
+# before they are decoded
+MAX_TEXT_LENGTH = 1000
+MAX_USERNAME_LENGTH = 32
+MAX_INBOUND_BYTES = 16 * 1024
+
+# Messages sent on connect; older ones are fetched page by page with load_older
+DEFAULT_WELCOME_MESSAGES = 50
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# Outbound frames queued per client before the slow-consumer policy applies
+DEFAULT_QUEUE_SIZE = 256
+# Typing changes are collected and sent as one typing_update per tick
+DEFAULT_TYPING_INTERVAL = 0.25
+# A client stops counting as typing this long after its last typing_start
+DEFAULT_TYPING_TTL = 6.0
+
+# Event loop lag, in seconds, at which each load shedding level starts:
+# no typing broadcasts, then no join/leave notices, then a shorter history
+# for joining clients
+DEFAULT_SHED_THRESHOLDS = (0.05, 0.1, 0.25)
+LAG_SAMPLE_INTERVAL = 0.1
+SHED_WELCOME_MESSAGES = 10
+
+# Message ids are milliseconds since ID_EPOCH_MS followed by a per-millisecond
+# sequence and the id of the node (worker process) that issued them. They
+# sort by creation time, are unique across nodes and stay below 2**53 (safe
+# integers in JavaScript) for the next ~69 years
+ID_EPOCH_MS = 1704067200000  # 2024-01-01T00:00:00Z
+ID_SEQUENCE_BITS = 8
+ID_NODE_BITS = 4
+MAX_NODES = 1 << ID_NODE_BITS
+# Paging cursors are clamped to what the history stores can compare against
+MAX_CURSOR = (1 << 63) - 1
+
+class MessageIdGenerator:
+    """Monotonically increasing, time-sortable message ids"""
+
+    def __init__(self, node=0):
+        if not 0 <= node < MAX_NODES:
+            raise ValueError(f"node must be between 0 and {MAX_NODES - 1}")
+        self.node = node
+        self.last_id = 0
+        self._last_sequence = 0
+
+    def next_id(self):
+        """Return an id greater than every id handed out before"""
+        now_ms = int(time.time() * 1000) - ID_EPOCH_MS
+        # If the clock stalls or steps back, keep counting from the last id
+        self._last_sequence = max(self._last_sequence + 1, now_ms << ID_SEQUENCE_BITS)
+        self.last_id = (self._last_sequence << ID_NODE_BITS) | self.node
+        return self.last_id
+
+    def observe(self, message_id):
+        """Make sure future ids sort after an id issued before a restart or by another node"""
+        self._last_sequence = max(self._last_sequence, message_id >> ID_NODE_BITS)
+
+class Frame:
+    """An event encoded to JSON bytes once and shared by every recipient
+
+    The MessagePack encoding is made on first use, only if a client that
+    negotiated it receives the frame, and is then shared the same way.
+    """
+    
+    __slots__ = ('type', 'id', 'event', 'data', 'spliced', '_packed')
+
+    def __init__(self, event, data=None):
+        self.type = event.get('type')
+        self.id = event.get('id')
+        self.event = event
+        self.data = data if data is not None else codec.dumps(event)
+        self.spliced = None
+        self._packed = None
+
+    @classmethod
+    def with_raw_field(cls, event, key, raw, frames=None):
+        """Build a frame whose `key` field is spliced in from already-encoded JSON
+
+        `frames`, if given, are the frames `raw` was built from, so other
+        encodings can be spliced together from them too.
+        """
+        head = codec.dumps(event)[:-1]
+        separator = b', ' if event else b''
+        frame = cls(event, head + separator + codec.dumps(key) + b': ' + raw + b'}')
+        frame.spliced = (key, frames)
+        return frame
+
+    def packed(self):
+        """Return the frame encoded as MessagePack"""
+        if self._packed is None:
+            if self.spliced is None:
+                self._packed = msgpack.packb(self.event)
+            else:
+                key, frames = self.spliced
+                if frames is None:
+                    # Raw JSON that was never decoded, e.g. read from the store
+                    self._packed = msgpack.packb(codec.loads(self.data))
+                else:
+                    self._packed = pack_with_array(
+                        self.event, key, [frame.packed() for frame in frames]
+                    )
+        return self._packed
+
+def encode_frame_list(frames):
+    """Join already-encoded frames into a JSON array"""
+    return b'[' + b', '.join(frame.data for frame in frames) + b']'
+
+def pack_with_array(event, key, items):
+    """Pack a map with an extra `key` holding already-packed items"""
+    packer = msgpack.Packer()
+    parts = [packer.pack_map_header(len(event) + 1)]
+    for name, value in event.items():
+        parts.append(packer.pack(name))
+        parts.append(packer.pack(value))
+    parts.append(packer.pack(key))
+    parts.append(packer.pack_array_header(len(items)))
+    parts.extend(items)
+    return b''.join(parts)
+
+class JsonFormat:
+    """The default wire format: one JSON text message per frame"""
+
+    subprotocol = 'messenger.json'
+    text = True
+
+    def encode(self, frame):
+        return frame.data
+
+    def encode_batch(self, events):
+        """Wrap encoded frames in a batch envelope without re-encoding them"""
+        return b'{"type": "batch", "events": [' + b', '.join(events) + b']}'
+
+    def decode(self, message):
+        return codec.loads(message)
+
+class MsgpackFormat:
+    """Binary wire format: one MessagePack binary message per frame"""
+
+    subprotocol = 'messenger.msgpack'
+    text = False
+
+    def encode(self, frame):
+        return frame.packed()
+
+    def encode_batch(self, events):
+        """Wrap encoded frames in a batch envelope without re-encoding them"""
+        return pack_with_array({'type': 'batch'}, 'events', events)
+
+    def decode(self, message):
+        if isinstance(message, str):
+            raise ValueError("expected a binary message")
+        return msgpack.unpackb(message)
+
+JSON_FORMAT = JsonFormat()
+
+# Wire formats clients can ask for with the websocket subprotocol header;
+# a client that asks for none gets JSON
+WIRE_FORMATS = {JSON_FORMAT.subprotocol: JSON_FORMAT}
+if msgpack is not None:
+    WIRE_FORMATS[MsgpackFormat.subprotocol] = MsgpackFormat()
+
+def select_subprotocol(connection, subprotocols):
+    """Pick the first wire format the client offers, or none for plain JSON"""
+    for subprotocol in subprotocols:
+        if subprotocol in WIRE_FORMATS:
+            return subprotocol
+    return None
+
+# Fire-and-forget tasks, referenced until they finish so they can't be
+# garbage collected while still running
+background_tasks = set()
+
+def run_in_background(coro):
+    """Run a coroutine as a task nobody awaits, logging it if it fails"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_task_done)
+    return task
+
+def background_task_done(task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Background task failed: {task.exception()}")
+
+def get_message_size(message):
+    """Return the size in bytes of a websocket message as it was on the wire"""
+    if isinstance(message, str) and not message.isascii():
+        return len(message.encode())
+    return len(message)
+
+def get_query_param(websocket, name):
+    """Return a query string parameter from the websocket request URL"""
+    values = parse_qs(urlsplit(websocket.request.path).query).get(name)
+    return values[0] if values else None
+
+def get_resume_cursor(websocket):
+    """Return the last message id a reconnecting client has seen, if any"""
+    value = get_query_param(websocket, 'since')
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+def get_requested_room(websocket):
+    """Return the valid room name a connecting client asked for, if any"""
+    return validate_room_name(get_query_param(websocket, 'room'))
+
+class Field:
+    """Expected type and maximum length of one field of a client message"""
+
+    __slots__ = ('types', 'max_length', 'required')
+
+    def __init__(self, *types, max_length=None, required=False):
+        self.types = types
+        self.max_length = max_length
+        self.required = required
+
+class Schema:
+    """Field checks for one message type, compiled into a flat tuple"""
+
+    def __init__(self, **fields):
+        self.checks = tuple(
+            (name, field.types, field.max_length, field.required)
+            for name, field in fields.items()
+        )
+
+    def validate(self, data):
+        """Return why a decoded message doesn't fit the schema, or None if it does"""
+        for name, types, max_length, required in self.checks:
+            value = data.get(name)
+            if value is None:
+                if required:
+                    return f"missing {name}"
+                continue
+            # Exact type checks, so True doesn't pass for an int
+            if type(value) not in types:
+                return f"{name} has the wrong type"
+            if max_length is not None and len(value) > max_length:
+                return f"{name} is too long"
+        return None
+
+USERNAME_FIELD = Field(str, max_length=MAX_USERNAME_LENGTH)
+ROOM_FIELD = Field(str, max_length=MAX_ROOM_NAME_LENGTH)
+
+def validate_room_name(name):
+    """Return a cleaned room name, or None if it isn't acceptable"""
+    if not isinstance(name, str):
+        return None
+    name = name.strip()
+    if not name or len(name) > MAX_ROOM_NAME_LENGTH:
+        return None
+    return name
+
+class SlowConsumerPolicy:
+    """What to do when a client's outbound queue is full
+
+    Queued typing updates are dropped first since a newer one supersedes
+    them, then the backlog is coalesced into a single batch frame, and if
+    that still doesn't fit the client is disconnected.
+    """
+
+    def __init__(self, max_queue=DEFAULT_QUEUE_SIZE, drop_typing=True, coalesce=True,
+                 max_batch_bytes=1024 * 1024, close_code=SLOW_CONSUMER_CLOSE_CODE):
+        self.max_queue = max_queue
+        self.drop_typing = drop_typing
+        self.coalesce = coalesce
+        self.max_batch_bytes = max_batch_bytes
+        self.close_code = close_code
+
+class TokenBucket:
+    """Allows `rate` events per second on average with bursts of up to `burst`"""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic() if now is None else now
+
+    def take(self, now):
+        """Spend a token if one is available, returning False if not"""
+        tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if tokens < 1:
+            self.tokens = tokens
+            return False
+        self.tokens = tokens - 1
+        return True
+
+class RateLimitPolicy:
+    """Per-connection rate limits on inbound client messages
+
+    Messages over their type's limit are dropped. Every drop is a strike;
+    strikes refill at `strike_rate` per second and a client that runs out
+    of them, `max_strikes` drops in a burst, is disconnected.
+    """
+
+    def __init__(self, limits=None, max_strikes=20, strike_rate=1.0,
+                 close_code=RATE_LIMIT_CLOSE_CODE):
+        self.limits = DEFAULT_RATE_LIMITS if limits is None else limits
+        self.max_strikes = max_strikes
+        self.strike_rate = strike_rate
+        self.close_code = close_code
+
+class RateLimiter:
+    """Token buckets of one connection, created per message type on first use"""
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.buckets = {}
+        self.strikes = TokenBucket(policy.strike_rate, policy.max_strikes)
+        self.dropped = 0
+        self.disconnecting = False
+
+    def allow(self, message_type):
+        """Return True if a message of this type may be handled now"""
+        if self.disconnecting:
+            return False
+        limit = self.policy.limits.get(message_type)
+        if limit is None:
+            return True
+        
+        now = time.monotonic()
+        bucket = self.buckets.get(message_type)
+        if bucket is None:
+            bucket = self.buckets[message_type] = TokenBucket(*limit, now)
+        if bucket.take(now):
+            return True
+        
+        self.dropped += 1
+        self.strikes.take(now)
+        return False
+
+    def exhausted(self):
+        """Return True once the client has run out of strikes"""
+        return self.strikes.tokens < 1
+
+class LoadShedder:
+    """Samples event loop lag and decides how much optional work to shed
+
+    The level rises as soon as the smoothed lag passes the next threshold
+    and falls one step at a time once the lag drops below half of the
+    current level's threshold, so it doesn't flap around a threshold.
+    """
+
+    def __init__(self, thresholds=DEFAULT_SHED_THRESHOLDS, interval=LAG_SAMPLE_INTERVAL,
+                 enabled=True):
+        self.thresholds = thresholds
+        self.interval = interval
+        self.enabled = enabled
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.level = 0
+
+    @property
+    def shed_typing(self):
+        return self.level >= 1
+
+    @property
+    def shed_presence(self):
+        return self.level >= 2
+
+    @property
+    def shed_history(self):
+        return self.level >= 3
+
+    async def run(self):
+        """Measure how late each periodic wakeup is, forever"""
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.record(max(0.0, loop.time() - started - self.interval))
+
+    def record(self, lag):
+        """Fold one lag sample into the smoothed lag and update the level"""
+        # Rise immediately, recover gradually
+        self.lag = lag if lag > self.lag else self.lag * 0.7 + lag * 0.3
+        if lag > self.max_lag:
+            self.max_lag = lag
+        if not self.enabled:
+            return
+        
+        level = self.level
+        while level < len(self.thresholds) and self.lag >= self.thresholds[level]:
+            level += 1
+        if level == self.level and level > 0 and self.lag < self.thresholds[level - 1] / 2:
+            level -= 1
+        if level != self.level:
+            logger.warning(
+                f"Event loop lag {self.lag * 1000:.0f} ms, load shedding level {self.level} -> {level}"
+            )
+            self.level = level
+
+class BatchingPolicy:
+    """How long a client's writer waits to collect frames into one batch
+
+    Once a frame is queued the writer waits `window` seconds, then sends
+    everything queued so far, at most `max_events` frames at a time, as a
+    single batch frame.
+    """
+
+    def __init__(self, window=0.005, max_events=64):
+        self.window = window
+        self.max_events = max_events
+
+class ClientOutbox:
+    """Bounded queue of frames drained by a dedicated writer task
+
+    Each entry is a `(frame_type, data, events)` tuple where `data` is the
+    frame in the client's wire format and `events` holds the member frames
+    of a coalesced batch and is None otherwise.
+    """
+
+    def __init__(self, websocket, policy, batching=None, wire_format=JSON_FORMAT, metrics=None):
+        self.websocket = websocket
+        self.policy = policy
+        self.batching = batching
+        self.wire_format = wire_format
+        self.metrics = metrics or ServerMetrics()
+        self.frames = deque()
+        self.ready = asyncio.Event()
+        self.closed = False
+        self.dropped = 0
+        self.writer = None
+
+    def start(self):
+        """Start the writer task"""
+        self.writer = asyncio.create_task(self._write_loop())
+
+    def stop(self):
+        """Stop the writer task and discard anything still queued"""
+        self.closed = True
+        self.frames.clear()
+        if self.writer and self.writer is not asyncio.current_task():
+            self.writer.cancel()
+
+    def put(self, frame):
+        """Queue a frame, applying the slow-consumer policy if the queue is full"""
+        if self.closed:
+            return False
+        
+        if len(self.frames) >= self.policy.max_queue and not self._make_room(frame.type):
+            if frame.type == 'typing_update' and self.policy.drop_typing:
+                self.dropped += 1
+                self.metrics.dropped_frames += 1
+                return True
+            self._disconnect()
+            return False
+        
+        data = self.wire_format.encode(frame)
+        self.frames.append((frame.type, data, None))
+        self.metrics.outbound.add(frame.type, len(data))
+        self.ready.set()
+        return True
+
+    def _make_room(self, frame_type):
+        """Free at least one slot in a full queue, returning False if impossible"""
+        policy = self.policy
+        
+        # Stale typing updates are superseded by whatever comes next
+        if policy.drop_typing:
+            kept = deque(entry for entry in self.frames if entry[0] != 'typing_update')
+            self.dropped += len(self.frames) - len(kept)
+            self.metrics.dropped_frames += len(self.frames) - len(kept)
+            self.frames = kept
+            if len(self.frames) < policy.max_queue:
+                return True
+            if frame_type == 'typing_update':
+                return False
+        
+        # Merge the backlog into one batch frame without re-encoding it
+        if policy.coalesce and len(self.frames) > 1:
+            events = []
+            for frame_type, data, members in self.frames:
+                events.extend(members if members is not None else (data,))
+            batch = self.wire_format.encode_batch(events)
+            if len(batch) <= policy.max_batch_bytes:
+                self.frames = deque([('batch', batch, events)])
+                return True
+        
+        return False
+
+    def _disconnect(self):
+        """Drop a client that can't keep up"""
+        logger.warning(
+            f"Disconnecting slow consumer with {len(self.frames)} queued frames"
+        )
+        self.metrics.slow_consumer_disconnects += 1
+        self.stop()
+        run_in_background(
+            self.websocket.close(self.policy.close_code, 'slow consumer')
+        )
+
+    def _take_batch(self):
+        """Remove up to max_events queued frames and return them as one frame"""
+        frames = self.frames
+        if len(frames) == 1 and frames[0][2] is None:
+            return frames.popleft()[1]
+        
+        events = []
+        max_events = self.batching.max_events
+        while frames and len(events) < max_events:
+            frame_type, data, members = frames.popleft()
+            events.extend(members if members is not None else (data,))
+        return self.wire_format.encode_batch(events)
+
+    async def _write_loop(self):
+        """Send queued frames in order until the connection closes"""
+        batching = self.batching
+        text = self.wire_format.text
+        try:
+            while not self.closed:
+                if batching is not None:
+                    # Give more frames a moment to arrive unless a full batch is waiting
+                    if len(self.frames) < batching.max_events:
+                        await asyncio.sleep(batching.window)
+                    while self.frames:
+                        await self.websocket.send(self._take_batch(), text=text)
+                else:
+                    while self.frames:
+                        frame_type, data, events = self.frames.popleft()
+                        await self.websocket.send(data, text=text)
+                self.ready.clear()
+                await self.ready.wait()
+        except websockets.exceptions.ConnectionClosed:
+            self.metrics.send_failures += 1
+        except Exception as e:
+            self.metrics.send_failures += 1
+            logger.error(f"Error sending message to client: {e}")
+
+class FanoutStats:
+    """Broadcast fan-out timings and the number of frames queued by broadcasts"""
+
     def __init__(self):
+        self.recipients = 0
+        self.histogram = Histogram(FANOUT_BUCKETS)
+
+    def record(self, recipients, seconds):
+        """Record one broadcast that reached `recipients` clients in `seconds`"""
+        self.recipients += recipients
+        self.histogram.observe(seconds)
+
+class Room:
+    """A conversation with its own subscribers, history and typing state"""
+
+    def __init__(self, name, history):
+        self.name = name
+        self.subscribers = {}
+        self.history = history
+        self.typing_clients = {}
+        self.typing_deadlines = {}
+        self.remote_typing_users = {}
+        self.remote_typing_deadlines = {}
+        self.sent_typing_users = frozenset()
+        self.published_typing_users = frozenset()
+        self.published_typing_at = 0.0
+        self._typing_frame = None
+        self._history_frame = None
+
+    def append(self, frame):
+        """Store a message frame, invalidating the cached history snapshot"""
+        self.history.append(frame)
+        self._history_frame = None
+
+    @property
+    def idle(self):
+        """True when nobody on this node is in the room and nobody anywhere is typing"""
+        return not (self.subscribers or self.typing_clients or self.remote_typing_users)
+
+    @property
+    def typing_users(self):
+        """Usernames of the clients typing in this room on this node"""
+        return set(self.typing_clients.values())
+
+    def add_typing_user(self, client_id, username, deadline):
+        """Mark a client as typing until `deadline`, returning True if the users typing changed"""
+        self.typing_deadlines[client_id] = deadline
+        if self.typing_clients.get(client_id) == username:
+            return False
+        self.typing_clients[client_id] = username
+        self._typing_frame = None
+        return True
+
+    def rename_typing_user(self, client_id, username):
+        """Show a typing client under a new name, returning True if it is typing"""
+        if client_id not in self.typing_clients:
+            return False
+        self.typing_clients[client_id] = username
+        self._typing_frame = None
+        return True
+
+    def discard_typing_user(self, client_id):
+        """Clear a client's typing state, returning True if that changed anything"""
+        self.typing_deadlines.pop(client_id, None)
+        if self.typing_clients.pop(client_id, None) is None:
+            return False
+        self._typing_frame = None
+        return True
+
+    def set_remote_typing_users(self, node_id, usernames, deadline=None):
+        """Replace the set of users typing in this room on another node until `deadline`"""
+        if usernames:
+            self.remote_typing_users[node_id] = set(usernames)
+            self.remote_typing_deadlines[node_id] = deadline
+        else:
+            self.remote_typing_users.pop(node_id, None)
+            self.remote_typing_deadlines.pop(node_id, None)
+        self._typing_frame = None
+
+    def get_typing_frame(self):
+        """Return the typing_update frame, rebuilding it only after a change"""
+        if self._typing_frame is None:
+            self._typing_frame = Frame({
+                'type': 'typing_update',
+                'room': self.name,
+                'typingUsers': list(self.get_all_typing_users())
+            })
+        return self._typing_frame
+
+    def get_all_typing_users(self):
+        """Return everyone typing in this room, on this node and the others"""
+        return frozenset(self.typing_users.union(*self.remote_typing_users.values()))
+
+class MessengerServer:
+    def __init__(self, history_store=None, slow_consumer_policy=None, batching=None,
+                 rate_limit_policy=None, handler_timings=None, load_shedder=None, index_page=None,
+                 welcome_messages=DEFAULT_WELCOME_MESSAGES,
+                 history_messages=DEFAULT_MAX_MESSAGES, history_bytes=DEFAULT_MAX_BYTES,
+                 max_rooms=DEFAULT_MAX_ROOMS, max_rooms_per_client=DEFAULT_MAX_ROOMS_PER_CLIENT,
+                 bus=None, node=0,
+                 typing_interval=DEFAULT_TYPING_INTERVAL, typing_ttl=DEFAULT_TYPING_TTL):
+        self.slow_consumer_policy = slow_consumer_policy or SlowConsumerPolicy()
+        self.batching = batching
+        self.rate_limit_policy = rate_limit_policy or RateLimitPolicy()
+        self.welcome_messages = welcome_messages
+        self.history_messages = history_messages
+        self.history_bytes = history_bytes
+        self.max_rooms = max_rooms
+        self.max_rooms_per_client = max_rooms_per_client
         self.clients = {}
-        self.messages = []
-        self.typing_users = set()
+        self.rooms = {}
+        # Names of the idle rooms that still hold history, least recently
+        # used first; they are forgotten when a new room needs the space
+        self.idle_rooms = {}
+        self.history_store = history_store
+        self.node_id = str(node)
+        self.bus = bus or InProcessBackend(self.node_id)
+        self.ids = MessageIdGenerator(node)
+        self.fanout_stats = FanoutStats()
+        self.metrics = ServerMetrics()
+        
+        # Timing is opt-in; without it nothing is wrapped
+        self.handler_timings = handler_timings
+        if handler_timings is not None:
+            self.broadcast_typing_update = self.timed('broadcast_typing_update',
+                                                      self.broadcast_typing_update)
+            self.unregister_client = self.timed('disconnect', self.unregister_client)
+        self.typing_interval = typing_interval
+        self.typing_ttl = typing_ttl
+        self.typing_changed = set()
+        # Heap of (deadline, client id, room name); entries superseded by a
+        # later typing_start or cleared by typing_stop are skipped when popped
+        self.typing_expiry = []
+        # The same for other nodes' typing sets, as (deadline, node id, room
+        # name), so a node that stops publishing doesn't leave users typing
+        self.remote_typing_expiry = []
+        # Rooms whose last published typing set wasn't empty; it is
+        # republished every half TTL to keep the other nodes' copies alive
+        self.typing_published = set()
+        self.load_shedder = load_shedder or LoadShedder()
+        self.index_page = index_page
+        self._tasks = []
+        
+        # Handlers for each client message type and the schema checked
+        # before the handler is called
+        self.handlers = {}
+        self.register_handler('message', self.handle_chat_message, Schema(
+            text=Field(str, max_length=MAX_TEXT_LENGTH, required=True),
+            username=USERNAME_FIELD, room=ROOM_FIELD
+        ))
+        self.register_handler('typing_start', self.handle_typing_start, Schema(
+            username=USERNAME_FIELD, room=ROOM_FIELD
+        ))
+        self.register_handler('typing_stop', self.handle_typing_stop, Schema(
+            room=ROOM_FIELD
+        ))
+        self.register_handler('username_change', self.handle_username_change, Schema(
+            username=Field(str, max_length=MAX_USERNAME_LENGTH, required=True)
+        ))
+        self.register_handler('load_older', self.handle_load_older, Schema(
+            before=Field(int), limit=Field(int), room=ROOM_FIELD
+        ))
+        self.register_handler('join_room', self.handle_join_room, Schema(
+            room=Field(str, max_length=MAX_ROOM_NAME_LENGTH, required=True), since=Field(int)
+        ))
+        self.register_handler('leave_room', self.handle_leave_room, Schema(
+            room=ROOM_FIELD
+        ))
+        self.register_handler('switch_room', self.handle_switch_room, Schema(
+            room=Field(str, max_length=MAX_ROOM_NAME_LENGTH, required=True), since=Field(int)
+        ))
+    
+    def process_request(self, connection, request):
+        """Answer plain HTTP requests before the websocket handshake
+
+        Serves /metrics and, to browsers, the chat page at /; anything else
+        carries on with the handshake.
+        """
+        path = urlsplit(request.path).path
+        if path == '/metrics':
+            return connection.respond(HTTPStatus.OK, self.render_metrics())
+        if (self.index_page is not None and path in ('/', '/index.html')
+                and request.headers.get('Upgrade', '').lower() != 'websocket'):
+            return self.index_page.respond(request)
+        return None
+    
+    def render_metrics(self):
+        """Return the server's counters in the Prometheus text format"""
+        metrics = self.metrics
+        writer = MetricsWriter({'node': self.node_id})
+        writer.gauge('messenger_connected_clients', "Connected websocket clients", len(self.clients))
+        writer.gauge('messenger_rooms', "Rooms held in memory", len(self.rooms))
+        writer.gauge('messenger_event_loop_lag_seconds', "Smoothed event loop lag",
+                     self.load_shedder.lag)
+        writer.gauge('messenger_event_loop_lag_max_seconds', "Largest event loop lag sampled",
+                     self.load_shedder.max_lag)
+        writer.gauge('messenger_load_shedding_level',
+                     "0 normal, 1 no typing updates, 2 no join/leave notices, 3 short history",
+                     self.load_shedder.level)
+        writer.gauge('messenger_history_messages', "Messages held in the in-memory histories",
+                     sum(len(room.history) for room in self.rooms.values()))
+        writer.gauge('messenger_history_bytes', "Encoded size of the in-memory histories",
+                     sum(room.history.total_bytes for room in self.rooms.values()))
+        writer.gauge('messenger_typing_users', "Clients on this node currently typing",
+                     sum(len(room.typing_clients) for room in self.rooms.values()))
+        writer.gauge('messenger_queued_frames', "Frames waiting in client outboxes",
+                     sum(len(client['outbox'].frames) for client in self.clients.values()))
+        writer.labeled_counter('messenger_inbound_frames_total', "Frames received from clients",
+                               'type', metrics.inbound.frames)
+        writer.labeled_counter('messenger_inbound_bytes_total', "Bytes received from clients",
+                               'type', metrics.inbound.bytes)
+        writer.labeled_counter('messenger_outbound_frames_total', "Frames queued for clients",
+                               'type', metrics.outbound.frames)
+        writer.labeled_counter('messenger_outbound_bytes_total', "Bytes queued for clients",
+                               'type', metrics.outbound.bytes)
+        writer.histogram('messenger_broadcast_duration_seconds',
+                         "Time to queue one broadcast for every recipient",
+                         self.fanout_stats.histogram)
+        writer.counter('messenger_broadcast_recipients_total', "Frames queued by broadcasts",
+                       self.fanout_stats.recipients)
+        if self.handler_timings is not None:
+            writer.summary('messenger_handler_duration_seconds',
+                           "Handler run time over the most recent calls",
+                           'handler', self.handler_timings.stats)
+        writer.counter('messenger_send_failures_total', "Client writers stopped by a failed send",
+                       metrics.send_failures)
+        writer.counter('messenger_dropped_frames_total', "Typing updates dropped for slow clients",
+                       metrics.dropped_frames)
+        writer.counter('messenger_slow_consumer_disconnects_total',
+                       "Clients disconnected for not keeping up", metrics.slow_consumer_disconnects)
+        writer.counter('messenger_rate_limit_disconnects_total',
+                       "Clients disconnected for exceeding rate limits", metrics.rate_limit_disconnects)
+        return writer.text()
+    
+    def register_handler(self, message_type, handler, schema=None):
+        """Dispatch client messages of a type to `handler(websocket, data)`"""
+        if self.handler_timings is not None:
+            handler = self.timed(message_type, handler)
+        self.handlers[message_type] = (handler, schema or Schema())
+    
+    def timed(self, name, handler):
+        """Wrap a coroutine function to feed the handler timings"""
+        return self.handler_timings.wrap(name, handler, lambda: self.fanout_stats.recipients)
+    
+    async def start(self):
+        """Start the periodic typing indicator expiry and flush and the lag monitor"""
+        self._tasks = [
+            asyncio.create_task(self._typing_loop()),
+            asyncio.create_task(self.load_shedder.run())
+        ]
+    
+    async def close(self):
+        """Stop the periodic tasks"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
         
+    def get_room(self, name):
+        """Return a room by name, creating it if the room limit allows
+
+        At the limit the room idle the longest is forgotten to make space.
+        The default room can always be created, so every client has
+        somewhere to be.
+        """
+        room = self.rooms.get(name)
+        if room is not None:
+            return room
+        
+        if len(self.rooms) >= self.max_rooms and name != DEFAULT_ROOM:
+            if not self.idle_rooms:
+                return None
+            oldest = next(iter(self.idle_rooms))
+            del self.idle_rooms[oldest]
+            del self.rooms[oldest]
+        room = Room(name, MessageHistory(self.history_messages, self.history_bytes))
+        self.rooms[name] = room
+        return room
+    
+    def update_room_usage(self, room):
+        """Track whether a room is in use, forgetting it once it is idle and empty"""
+        if self.rooms.get(room.name) is not room:
+            return
+        self.idle_rooms.pop(room.name, None)
+        if not room.idle:
+            return
+        if len(room.history):
+            self.idle_rooms[room.name] = None
+        else:
+            del self.rooms[room.name]
+    
+    def restore_history(self):
+        """Rebuild the in-memory histories from the tail of the history store"""
+        if self.history_store is None:
+            return
+        
+        records = self.history_store.load_recent(
+            self.history_messages, self.history_bytes, self.max_rooms
+        )
+        restored = 0
+        for data in records:
+            try:
+                frame = Frame(codec.loads(data), data)
+            except codec.DecodeError:
+                logger.warning("Skipping unreadable record in history store")
+                continue
+            room = self.get_room(frame.event.get('room', DEFAULT_ROOM))
+            if room is not None:
+                room.append(frame)
+                self.update_room_usage(room)
+                restored += 1
+            self.ids.observe(frame.id)
+        
+        logger.info(f"Restored {restored} messages in {len(self.rooms)} rooms from history store")
+    
     async def register_client(self, websocket):
         """Register a new client connection"""
         client_id = str(uuid.uuid4())
         username = f"User_{client_id[:6]}"
         
+        wire_format = WIRE_FORMATS.get(websocket.subprotocol, JSON_FORMAT)
+        outbox = ClientOutbox(
+            websocket, self.slow_consumer_policy, self.batching, wire_format, self.metrics
+        )
         client_info = {
             'id': client_id,
             'username': username,
             'websocket': websocket,
+            'format': wire_format,
+            'rate_limiter': RateLimiter(self.rate_limit_policy),
+            'outbox': outbox,
+            'rooms': set(),
+            'room': None,
             'joined_at': datetime.now()
         }
         
         self.clients[websocket] = client_info
+        outbox.start()
         logger.info(f"Client {username} connected")
         
         # Send welcome message
         welcome_data = {
             'type': 'welcome',
             'clientId': client_id,
-            'username': username,
-            'messages': self.messages
+            'username': username
         }
-        await websocket.send(json.dumps(welcome_data))
+        self.send_to(websocket, welcome_data)
         
-        # Notify others about new user
-        join_message = {
-            'id': str(uuid.uuid4()),
-            'type': 'user_joined',
-            'username': username,
-            'timestamp': datetime.now().isoformat()
-        }
-        await self.broadcast_message(join_message, exclude=websocket)
+        # Join the requested room, sending whatever history the client is
+        # missing since the cursor it reconnected with
+        room_name = get_requested_room(websocket) or DEFAULT_ROOM
+        await self.join_room(websocket, room_name, since=get_resume_cursor(websocket))
         
         try:
             # Handle messages from this client
@@ -66,109 +962,215 @@ class MessengerServer:
             
             logger.info(f"Client {username} disconnected")
             
-            # Remove from typing users
-            self.typing_users.discard(username)
-            
-            # Notify others about user leaving
-            leave_message = {
-                'id': str(uuid.uuid4()),
-                'type': 'user_left',
-                'username': username,
-                'timestamp': datetime.now().isoformat()
-            }
-            await self.broadcast_message(leave_message, exclude=websocket)
-            
-            # Update typing indicator
-            await self.broadcast_typing_update(exclude=websocket)
+            # Leave every room, notifying the others in each
+            for room_name in list(client_info['rooms']):
+                await self.leave_room(websocket, room_name)
             
             # Remove client
             del self.clients[websocket]
+            client_info['outbox'].stop()
+    
+    async def join_room(self, websocket, room_name, since=None):
+        """Subscribe a client to a room and make it the client's active room
+
+        Returns False if the room couldn't be created; a client left in no
+        room at all is put in the default room instead.
+        """
+        client_info = self.clients[websocket]
+        room = self.get_room(room_name)
+        joined = room is not None
+        if not joined:
+            self.send_to(websocket, {'type': 'error', 'message': 'Too many rooms'})
+            if client_info['rooms']:
+                return False
+            room_name, since = DEFAULT_ROOM, None
+            room = self.get_room(room_name)
+        
+        already_joined = websocket in room.subscribers
+        room.subscribers[websocket] = client_info
+        self.update_room_usage(room)
+        client_info['rooms'].add(room_name)
+        client_info['room'] = room_name
+        
+        self.send_to(websocket, {'type': 'room_joined', 'room': room_name})
+        self.send_frame(websocket, self.get_resync_frame(room, since))
+        
+        if already_joined or self.load_shedder.shed_presence:
+            return joined
+        
+        # Notify others about new user
+        join_message = {
+            'id': self.ids.next_id(),
+            'type': 'user_joined',
+            'room': room_name,
+            'username': client_info['username'],
+            'timestamp': datetime.now().isoformat()
+        }
+        await self.broadcast_message(join_message, room, exclude=websocket)
+        return joined
+    
+    async def leave_room(self, websocket, room_name):
+        """Unsubscribe a client from a room"""
+        client_info = self.clients[websocket]
+        room = self.rooms.get(room_name)
+        if room is None or websocket not in room.subscribers:
+            return
+        
+        del room.subscribers[websocket]
+        client_info['rooms'].discard(room_name)
+        if client_info['room'] == room_name:
+            client_info['room'] = next(iter(client_info['rooms']), None)
+        
+        username = client_info['username']
+        if room.discard_typing_user(client_info['id']):
+            self.typing_changed.add(room)
+        self.update_room_usage(room)
+        
+        if self.load_shedder.shed_presence:
+            return
+        
+        # Notify others about user leaving
+        leave_message = {
+            'id': self.ids.next_id(),
+            'type': 'user_left',
+            'room': room_name,
+            'username': username,
+            'timestamp': datetime.now().isoformat()
+        }
+        await self.broadcast_message(leave_message, room)
+    
+    def can_join_another_room(self, websocket, client_info, leaving=None):
+        """Return True if a client is below its room limit, telling it if not"""
+        if len(client_info['rooms'] - {leaving}) < self.max_rooms_per_client:
+            return True
+        self.send_to(websocket, {'type': 'error', 'message': 'Too many rooms joined'})
+        return False
+    
+    def get_client_room(self, client_info, data):
+        """Return the room a client message is addressed to, if the client is in it"""
+        room_name = data.get('room') or client_info['room']
+        if room_name not in client_info['rooms']:
+            return None
+        return self.rooms.get(room_name)
     
     async def handle_message(self, websocket, message):
         """Handle incoming message from client"""
         try:
-            data = json.loads(message)
             client_info = self.clients.get(websocket)
             
             if not client_info:
                 return
             
+            try:
+                data = client_info['format'].decode(message)
+            except ValueError:
+                self.reject_invalid(websocket, client_info, message,
+                                    f"invalid {client_info['format'].subprotocol} message")
+                return
+            if not isinstance(data, dict):
+                self.reject_invalid(websocket, client_info, message, "non-object message")
+                return
+            
             message_type = data.get('type')
+            entry = self.handlers.get(message_type) if isinstance(message_type, str) else None
+            if entry is None:
+                self.reject_invalid(websocket, client_info, message, "unknown message type")
+                return
+            self.metrics.inbound.add(message_type, get_message_size(message))
             
-            if message_type == 'message':
-                await self.handle_chat_message(websocket, data)
-            elif message_type == 'typing_start':
-                await self.handle_typing_start(websocket, data)
-            elif message_type == 'typing_stop':
-                await self.handle_typing_stop(websocket, data)
-            elif message_type == 'username_change':
-                await self.handle_username_change(websocket, data)
+            if not self.check_rate_limit(websocket, client_info, message_type):
+                return
+            
+            handler, schema = entry
+            error = schema.validate(data)
+            if error is not None:
+                logger.debug(f"Rejected {message_type} from {client_info['username']}: {error}")
+                return
+            
+            await handler(websocket, data)
                 
-        except json.JSONDecodeError:
-            logger.error("Invalid JSON received")
         except Exception as e:
             logger.error(f"Error handling message: {e}")
     
+    def reject_invalid(self, websocket, client_info, message, reason):
+        """Drop a frame that isn't a known message, charging it to the 'invalid' limit"""
+        self.metrics.inbound.add('invalid', get_message_size(message))
+        logger.debug(f"Rejected {reason} from {client_info['username']}")
+        self.check_rate_limit(websocket, client_info, 'invalid')
+    
+    def check_rate_limit(self, websocket, client_info, message_type):
+        """Return True if a message is within its limit, disconnecting clients out of strikes"""
+        limiter = client_info['rate_limiter']
+        if limiter.allow(message_type):
+            return True
+        
+        if limiter.exhausted() and not limiter.disconnecting:
+            limiter.disconnecting = True
+            self.metrics.rate_limit_disconnects += 1
+            logger.warning(
+                f"Disconnecting {client_info['username']} after {limiter.dropped} "
+                f"rate-limited messages"
+            )
+            run_in_background(
+                websocket.close(self.rate_limit_policy.close_code, 'rate limit exceeded')
+            )
+        return False
+    
     async def handle_chat_message(self, websocket, data):
         """Handle chat message"""
         client_info = self.clients[websocket]
+        room = self.get_client_room(client_info, data)
         text = data.get('text', '').strip()
         
-        if not text:
+        if not text or room is None:
             return
         
-        # Update username if provided
-        new_username = data.get('username', '').strip()
-        if new_username and new_username != client_info['username']:
-            old_username = client_info['username']
-            client_info['username'] = new_username
-            
-            # Notify about username change
-            username_change_msg = {
-                'id': str(uuid.uuid4()),
-                'type': 'username_changed',
-                'oldUsername': old_username,
-                'newUsername': new_username,
-                'timestamp': datetime.now().isoformat()
-            }
-            await self.broadcast_message(username_change_msg)
+        await self.apply_username_field(websocket, client_info, data)
         
         # Create message
         message_data = {
-            'id': str(uuid.uuid4()),
+            'id': self.ids.next_id(),
             'type': 'message',
+            'room': room.name,
             'username': client_info['username'],
             'text': text,
             'timestamp': datetime.now().isoformat()
         }
         
-        # Store message (keep only last 100)
-        self.messages.append(message_data)
-        if len(self.messages) > 100:
-            self.messages.pop(0)
+        # Store the encoded frame; the history evicts the oldest as needed
+        message_frame = Frame(message_data)
+        room.append(message_frame)
+        if self.history_store is not None:
+            self.history_store.append(message_frame)
         
-        # Broadcast to all clients
-        await self.broadcast_message(message_data)
+        # Broadcast to everyone in the room, on this node and the others
+        await self.broadcast_frame(message_frame, room)
+        self.publish(message_frame)
     
     async def handle_typing_start(self, websocket, data):
         """Handle typing start"""
         client_info = self.clients[websocket]
-        username = data.get('username', client_info['username'])
+        room = self.get_client_room(client_info, data)
+        if room is None:
+            return
         
-        # Update username if provided
-        if username != client_info['username']:
-            client_info['username'] = username
+        await self.apply_username_field(websocket, client_info, data)
+        username = client_info['username']
         
-        self.typing_users.add(username)
-        await self.broadcast_typing_update(exclude=websocket)
+        deadline = asyncio.get_running_loop().time() + self.typing_ttl
+        heapq.heappush(self.typing_expiry, (deadline, client_info['id'], room.name))
+        if room.add_typing_user(client_info['id'], username, deadline):
+            self.typing_changed.add(room)
     
     async def handle_typing_stop(self, websocket, data):
         """Handle typing stop"""
         client_info = self.clients[websocket]
-        username = client_info['username']
+        room = self.get_client_room(client_info, data)
+        if room is None:
+            return
         
-        self.typing_users.discard(username)
-        await self.broadcast_typing_update(exclude=websocket)
+        if room.discard_typing_user(client_info['id']):
+            self.typing_changed.add(room)
     
     async def handle_username_change(self, websocket, data):
         """Handle username change"""
@@ -178,84 +1180,544 @@ class MessengerServer:
         if not new_username or new_username == client_info['username']:
             return
         
-        old_username = client_info['username']
-        client_info['username'] = new_username
-        
-        # Update typing users set
-        if old_username in self.typing_users:
-            self.typing_users.discard(old_username)
-            self.typing_users.add(new_username)
-        
-        # Notify all clients
-        username_change_msg = {
-            'id': str(uuid.uuid4()),
-            'type': 'username_changed',
-            'oldUsername': old_username,
-            'newUsername': new_username,
-            'timestamp': datetime.now().isoformat()
-        }
-        await self.broadcast_message(username_change_msg)
+        await self.rename_client(client_info, new_username)
         
         # Send confirmation to the client
         confirmation = {
             'type': 'username_updated',
             'username': new_username
         }
-        await websocket.send(json.dumps(confirmation))
+        self.send_to(websocket, confirmation)
+    
+    async def apply_username_field(self, websocket, client_info, data):
+        """Rename a client from the optional username field of another message type
+
+        Such renames count against the username_change limit like explicit
+        ones; over the limit the field is ignored.
+        """
+        new_username = (data.get('username') or '').strip()
+        if (new_username and new_username != client_info['username']
+                and self.check_rate_limit(websocket, client_info, 'username_change')):
+            await self.rename_client(client_info, new_username)
+    
+    async def rename_client(self, client_info, new_username):
+        """Change a client's username and notify every room it is in"""
+        old_username = client_info['username']
+        client_info['username'] = new_username
+        
+        for room_name in client_info['rooms']:
+            room = self.rooms[room_name]
+            
+            # Update typing users set
+            if room.rename_typing_user(client_info['id'], new_username):
+                self.typing_changed.add(room)
+            
+            username_change_msg = {
+                'id': self.ids.next_id(),
+                'type': 'username_changed',
+                'room': room_name,
+                'oldUsername': old_username,
+                'newUsername': new_username,
+                'timestamp': datetime.now().isoformat()
+            }
+            await self.broadcast_message(username_change_msg, room)
+    
+    async def handle_join_room(self, websocket, data):
+        """Handle a request to join a room"""
+        client_info = self.clients[websocket]
+        room_name = validate_room_name(data.get('room'))
+        if room_name is None:
+            return
+        if room_name not in client_info['rooms'] and not self.can_join_another_room(
+                websocket, client_info):
+            return
+        
+        await self.join_room(websocket, room_name, since=data.get('since'))
     
-    async def broadcast_message(self, message_data, exclude=None):
-        """Broadcast message to all connected clients"""
-        if not self.clients:
+    async def handle_leave_room(self, websocket, data):
+        """Handle a request to leave a room"""
+        client_info = self.clients[websocket]
+        room_name = data.get('room') or client_info['room']
+        if room_name not in client_info['rooms']:
             return
         
-        message_json = json.dumps(message_data)
-        disconnected_clients = []
+        await self.leave_room(websocket, room_name)
+        self.send_to(websocket, {'type': 'room_left', 'room': room_name})
+    
+    async def handle_switch_room(self, websocket, data):
+        """Handle a request to leave the active room for another one"""
+        client_info = self.clients[websocket]
+        room_name = validate_room_name(data.get('room'))
+        if room_name is None:
+            return
         
-        for websocket, client_info in self.clients.items():
-            if websocket == exclude:
-                continue
-            
+        current = client_info['room']
+        if room_name not in client_info['rooms'] and not self.can_join_another_room(
+                websocket, client_info, leaving=current):
+            return
+        
+        # Join first, so a client whose new room can't be created stays put
+        if await self.join_room(websocket, room_name, since=data.get('since')):
+            if current is not None and current != room_name:
+                await self.leave_room(websocket, current)
+    
+    def get_history_frame(self, room):
+        """Return a room's encoded history snapshot, rebuilding it only after an append"""
+        if self.load_shedder.shed_history:
+            # Shorter and uncached while overloaded; clients page in the rest
+            return self.build_history_frame(room, SHED_WELCOME_MESSAGES)
+        if room._history_frame is None:
+            room._history_frame = self.build_history_frame(room, self.welcome_messages)
+        return room._history_frame
+    
+    def build_history_frame(self, room, count):
+        """Encode a room's last `count` messages as a history reset"""
+        frames = room.history.recent(count)
+        has_more = len(frames) < len(room.history) or self.history_store is not None
+        return Frame.with_raw_field(
+            {'type': 'history', 'room': room.name, 'reset': True, 'hasMore': has_more},
+            'messages', encode_frame_list(frames), frames
+        )
+    
+    def get_resync_frame(self, room, since):
+        """Return the messages stored after `since`, or a reset if it's gone"""
+        if since is not None:
+            missed = room.history.since(since)
+            limit = SHED_WELCOME_MESSAGES if self.load_shedder.shed_history else self.welcome_messages
+            # After a long absence a reset is cheaper than replaying everything
+            if missed is not None and len(missed) <= limit:
+                return Frame.with_raw_field(
+                    {'type': 'history', 'room': room.name, 'reset': False},
+                    'messages', encode_frame_list(missed), missed
+                )
+        return self.get_history_frame(room)
+    
+    async def handle_load_older(self, websocket, data):
+        """Handle a request for the page of messages before a cursor
+
+        Without a cursor the newest page is sent, for clients whose history
+        came without messages because the room's memory was empty.
+        """
+        room = self.get_client_room(self.clients[websocket], data)
+        before = data.get('before')
+        cursor = MAX_CURSOR if before is None else max(0, min(before, MAX_CURSOR))
+        if room is None:
+            return
+        
+        limit = data.get('limit')
+        if limit is None or limit < 1:
+            limit = DEFAULT_PAGE_SIZE
+        limit = min(limit, MAX_PAGE_SIZE)
+        
+        # Serve from memory when it covers the page, otherwise from the store
+        frames = room.history.before(cursor, limit)
+        if len(frames) < limit and self.history_store is not None:
+            records = await self.history_store.load_before(room.name, cursor, limit)
+            count = len(records)
+            messages = b'[' + b', '.join(records) + b']'
+            frames = None
+        else:
+            count = len(frames)
+            messages = encode_frame_list(frames)
+        
+        page = Frame.with_raw_field(
+            {'type': 'older_messages', 'room': room.name, 'before': before, 'hasMore': count == limit},
+            'messages', messages, frames
+        )
+        self.send_frame(websocket, page)
+    
+    def send_to(self, websocket, message_data):
+        """Queue a message for a single client"""
+        self.send_frame(websocket, Frame(message_data))
+    
+    def send_frame(self, websocket, frame):
+        """Queue an encoded frame for a single client"""
+        client_info = self.clients.get(websocket)
+        if client_info:
+            client_info['outbox'].put(frame)
+    
+    async def broadcast_message(self, message_data, room, exclude=None):
+        """Broadcast a room event to local subscribers and to the other nodes"""
+        frame = Frame(message_data)
+        await self.broadcast_frame(frame, room, exclude=exclude)
+        self.publish(frame)
+    
+    def publish(self, frame):
+        """Share an encoded frame with the other nodes, if there are any"""
+        self.bus.publish(frame.data)
+    
+    def publish_typing_state(self, room):
+        """Share the users typing in a room on this node with the other nodes"""
+        room.published_typing_at = asyncio.get_running_loop().time()
+        self.publish(Frame({
+            'type': 'typing_state',
+            'room': room.name,
+            'typingUsers': list(room.typing_users)
+        }))
+    
+    async def _typing_loop(self):
+        while True:
+            await asyncio.sleep(self.typing_interval)
             try:
-                await websocket.send(message_json)
-            except websockets.exceptions.ConnectionClosed:
-                disconnected_clients.append(websocket)
+                now = asyncio.get_running_loop().time()
+                self.expire_typing_users(now)
+                # Changes pile up while shedding and go out once it stops
+                if not self.load_shedder.shed_typing:
+                    await self.flush_typing_updates(now)
             except Exception as e:
-                logger.error(f"Error sending message to client: {e}")
-                disconnected_clients.append(websocket)
+                logger.error(f"Error flushing typing updates: {e}")
+    
+    def expire_typing_users(self, now):
+        """Clear the typing state of every client whose deadline has passed"""
+        expiry = self.typing_expiry
+        while expiry and expiry[0][0] <= now:
+            deadline, client_id, room_name = heapq.heappop(expiry)
+            room = self.rooms.get(room_name)
+            if room is None or room.typing_deadlines.get(client_id) != deadline:
+                continue
+            room.discard_typing_user(client_id)
+            self.typing_changed.add(room)
         
-        # Clean up disconnected clients
-        for websocket in disconnected_clients:
-            await self.unregister_client(websocket)
+        expiry = self.remote_typing_expiry
+        while expiry and expiry[0][0] <= now:
+            deadline, node_id, room_name = heapq.heappop(expiry)
+            room = self.rooms.get(room_name)
+            if room is None or room.remote_typing_deadlines.get(node_id) != deadline:
+                continue
+            room.set_remote_typing_users(node_id, ())
+            self.typing_changed.add(room)
+            self.update_room_usage(room)
     
-    async def broadcast_typing_update(self, exclude=None):
-        """Broadcast typing indicator update"""
-        typing_data = {
-            'type': 'typing_update',
-            'typingUsers': list(self.typing_users)
-        }
-        await self.broadcast_message(typing_data, exclude=exclude)
+    async def flush_typing_updates(self, now):
+        """Send one typing update for each room whose typing users changed"""
+        # Rooms where someone started and stopped within one tick end up
+        # with the set they started with, and nothing is sent for them
+        changed, self.typing_changed = self.typing_changed, set()
+        for room in changed:
+            local_users = frozenset(room.typing_users)
+            if local_users != room.published_typing_users:
+                room.published_typing_users = local_users
+                self.publish_typing_state(room)
+                if local_users:
+                    self.typing_published.add(room)
+                else:
+                    self.typing_published.discard(room)
+            
+            all_users = room.get_all_typing_users()
+            if all_users != room.sent_typing_users:
+                room.sent_typing_users = all_users
+                await self.broadcast_typing_update(room)
+        
+        for room in self.typing_published:
+            if now - room.published_typing_at >= self.typing_ttl / 2:
+                self.publish_typing_state(room)
+    
+    async def handle_bus_event(self, node_id, data):
+        """Deliver an event published by another node to local subscribers"""
+        frame = Frame(codec.loads(data), data)
+        room = self.get_room(frame.event.get('room', DEFAULT_ROOM))
+        if room is None:
+            return
+        
+        if frame.type == 'typing_state':
+            usernames = frame.event.get('typingUsers')
+            deadline = asyncio.get_running_loop().time() + self.typing_ttl
+            room.set_remote_typing_users(node_id, usernames, deadline)
+            if usernames:
+                heapq.heappush(self.remote_typing_expiry, (deadline, node_id, room.name))
+            self.typing_changed.add(room)
+        else:
+            if frame.type == 'message':
+                # Another host's clock may be ahead; keep new ids after its messages
+                self.ids.observe(frame.id)
+                room.append(frame)
+                # A shared store already has it from the node that published it
+                if self.history_store is not None and not self.history_store.shared:
+                    self.history_store.append(frame)
+            await self.broadcast_frame(frame, room)
+        self.update_room_usage(room)
+    
+    async def broadcast_frame(self, frame, room, exclude=None):
+        """Queue the same encoded frame for every subscriber of a room"""
+        # Each client's writer task drains its own queue, so a slow peer
+        # only backs up its own outbox
+        recipients = 0
+        
+        started = time.perf_counter()
+        for websocket, client_info in room.subscribers.items():
+            if websocket is exclude:
+                continue
+            client_info['outbox'].put(frame)
+            recipients += 1
+        elapsed = time.perf_counter() - started
+        
+        self.fanout_stats.record(recipients, elapsed)
+        logger.debug(
+            f"Broadcast {frame.type} to {recipients} clients in {room.name} "
+            f"in {elapsed * 1000:.3f} ms"
+        )
+    
+    async def broadcast_typing_update(self, room, exclude=None):
+        """Broadcast a room's typing indicator update"""
+        if not room.subscribers:
+            return
+        
+        await self.broadcast_frame(room.get_typing_frame(), room, exclude=exclude)
 
-async def main():
+def parse_rate_limit(value):
+    """Parse a TYPE=RATE[/BURST] or TYPE=off command line rate limit"""
+    message_type, _, limit = value.partition('=')
+    if not message_type or not limit:
+        raise argparse.ArgumentTypeError(f"expected TYPE=RATE[/BURST] or TYPE=off, got {value!r}")
+    if limit == 'off':
+        return message_type, None
+    rate, _, burst = limit.partition('/')
+    try:
+        rate = float(rate)
+        burst = float(burst) if burst else max(1.0, rate)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid rate limit {value!r}")
+    if rate <= 0 or burst < 1:
+        raise argparse.ArgumentTypeError(f"invalid rate limit {value!r}")
+    return message_type, (rate, burst)
+
+def get_rate_limits(overrides):
+    """Apply command line rate limit overrides to the defaults"""
+    limits = dict(DEFAULT_RATE_LIMITS)
+    for message_type, limit in overrides:
+        if limit is None:
+            limits.pop(message_type, None)
+        else:
+            limits[message_type] = limit
+    return limits
+
+def parse_args():
+    """Parse command line options"""
+    parser = argparse.ArgumentParser(description="Messenger WebSocket server")
+    parser.add_argument('--host', default='localhost',
+                        help="interface to listen on")
+    parser.add_argument('--port', type=int, default=8080,
+                        help="port to listen on")
+    parser.add_argument('--workers', type=int, default=1,
+                        help=f"number of server processes sharing the port (at most {MAX_NODES})")
+    parser.add_argument('--bus-path',
+                        help="Unix socket the workers share events over "
+                             "(default: a per-port path in the temp directory)")
+    parser.add_argument('--redis',
+                        help="share events with other server nodes through Redis pub/sub, "
+                             "e.g. redis://localhost:6379")
+    parser.add_argument('--redis-channel', default=DEFAULT_REDIS_CHANNEL,
+                        help="Redis channel events are published on")
+    parser.add_argument('--node', type=int, default=0,
+                        help="id of this node, unique among nodes sharing a Redis channel "
+                             "(with --workers, the id of the first worker)")
+    parser.add_argument('--index',
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'index.html'),
+                        help="page served to browsers at / (default: the bundled index.html)")
+    parser.add_argument('--no-index', action='store_true',
+                        help="don't serve a page, only websockets and /metrics")
+    parser.add_argument('--history-messages', type=int, default=DEFAULT_MAX_MESSAGES,
+                        help="maximum number of messages kept in memory per room")
+    parser.add_argument('--history-bytes', type=int, default=DEFAULT_MAX_BYTES,
+                        help="maximum total encoded size of each room's in-memory history")
+    parser.add_argument('--max-rooms', type=int, default=DEFAULT_MAX_ROOMS,
+                        help="maximum number of rooms kept in memory")
+    parser.add_argument('--max-rooms-per-client', type=int, default=DEFAULT_MAX_ROOMS_PER_CLIENT,
+                        help="maximum number of rooms one client can be in at once")
+    storage = parser.add_mutually_exclusive_group()
+    storage.add_argument('--log-dir',
+                         help="directory for the on-disk message log "
+                              "(each worker uses its own subdirectory)")
+    storage.add_argument('--sqlite',
+                         help="path of a SQLite database to keep the full message history in")
+    parser.add_argument('--log-segment-bytes', type=int, default=DEFAULT_SEGMENT_BYTES,
+                        help="size at which the message log starts a new segment")
+    parser.add_argument('--flush-interval', type=float, default=DEFAULT_FLUSH_INTERVAL,
+                        help="seconds to group appends before each write to disk")
+    parser.add_argument('--welcome-messages', type=int, default=DEFAULT_WELCOME_MESSAGES,
+                        help="number of recent messages sent to a connecting client")
+    parser.add_argument('--typing-interval', type=float, default=DEFAULT_TYPING_INTERVAL,
+                        help="seconds between aggregated typing indicator updates")
+    parser.add_argument('--typing-ttl', type=float, default=DEFAULT_TYPING_TTL,
+                        help="seconds a client counts as typing after its last typing_start")
+    parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE,
+                        help="outbound frames queued per client before the slow-consumer policy applies")
+    parser.add_argument('--batch-window', type=float, default=0,
+                        help="seconds to collect outbound frames into one batch frame per client "
+                             "(default: send every frame on its own)")
+    parser.add_argument('--batch-max-events', type=int, default=64,
+                        help="maximum number of frames in one batch")
+    parser.add_argument('--rate-limit', type=parse_rate_limit, action='append', default=[],
+                        metavar='TYPE=RATE[/BURST]',
+                        help="per-connection limit on a client message type, in messages per second "
+                             "(TYPE=off removes the limit); may be repeated")
+    parser.add_argument('--handler-timing', action='store_true',
+                        help="time every message handler and export rolling percentiles")
+    parser.add_argument('--slow-handler-ms', type=float, default=50,
+                        help="with --handler-timing, log handler calls slower than this")
+    parser.add_argument('--shed-lag-ms', type=float, nargs=3, metavar=('TYPING', 'PRESENCE', 'HISTORY'),
+                        default=[threshold * 1000 for threshold in DEFAULT_SHED_THRESHOLDS],
+                        help="event loop lag at which typing updates, join/leave notices and "
+                             "full welcome history are shed in turn")
+    parser.add_argument('--no-load-shedding', action='store_true',
+                        help="only measure event loop lag, never shed work")
+    parser.add_argument('--rate-limit-strikes', type=int, default=20,
+                        help="rate-limited messages in a burst before a client is disconnected")
+    args = parser.parse_args()
+    
+    if not 1 <= args.workers <= MAX_NODES:
+        parser.error(f"--workers must be between 1 and {MAX_NODES}")
+    if not 0 <= args.node <= MAX_NODES - args.workers:
+        parser.error(f"--node plus --workers must not exceed {MAX_NODES}")
+    if args.batch_window < 0 or args.batch_max_events < 1:
+        parser.error("--batch-window must not be negative and --batch-max-events must be positive")
+    if args.typing_interval <= 0:
+        parser.error("--typing-interval must be positive")
+    if args.history_messages < 1 or args.history_bytes < 1:
+        parser.error("--history-messages and --history-bytes must be positive")
+    if args.queue_size < 1:
+        parser.error("--queue-size must be positive")
+    if args.max_rooms < 1 or args.max_rooms_per_client < 1:
+        parser.error("--max-rooms and --max-rooms-per-client must be positive")
+    if args.bus_path is None:
+        args.bus_path = os.path.join(tempfile.gettempdir(), f"messenger-{args.port}.sock")
+    return args
+
+def stop_on_sigterm():
+    """Return an event that is set when the process receives SIGTERM"""
+    stop = asyncio.Event()
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    except NotImplementedError:
+        pass  # Not available on Windows
+    return stop
+
+async def main(args, node=None):
     """Main server function"""
-    server = MessengerServer()
-    
-    logger.info("Starting WebSocket server on localhost:8080")
-    
-    # Start the WebSocket server
-    async with websockets.serve(
-        server.register_client,
-        "localhost",
-        8080,
-        ping_interval=20,
-        ping_timeout=10
-    ):
-        logger.info("WebSocket server is running on ws://localhost:8080")
-        # Keep the server running
-        await asyncio.Future()  # Run forever
+    if node is None:
+        node = args.node
+    history_store = None
+    if args.log_dir:
+        log_dir = args.log_dir
+        if args.workers > 1:
+            log_dir = os.path.join(log_dir, f"worker-{node}")
+        history_store = MessageLog(log_dir, args.log_segment_bytes, args.flush_interval)
+    elif args.sqlite:
+        # Workers on one host share the file; hosts behind Redis each have their own
+        history_store = SQLiteHistory(args.sqlite, args.flush_interval, shared=not args.redis)
+    if history_store is not None:
+        history_store.open()
+    
+    index_page = None
+    if not args.no_index:
+        index_page = StaticFile(args.index)
+    
+    if args.redis:
+        bus = RedisBackend(args.redis, str(node), args.redis_channel)
+    elif args.workers > 1:
+        bus = UnixSocketBus(args.bus_path, str(node))
+    else:
+        bus = InProcessBackend(str(node))
+    
+    server = MessengerServer(
+        history_store=history_store,
+        history_messages=args.history_messages,
+        history_bytes=args.history_bytes,
+        max_rooms=args.max_rooms,
+        max_rooms_per_client=args.max_rooms_per_client,
+        slow_consumer_policy=SlowConsumerPolicy(max_queue=args.queue_size),
+        batching=BatchingPolicy(args.batch_window, args.batch_max_events) if args.batch_window else None,
+        rate_limit_policy=RateLimitPolicy(get_rate_limits(args.rate_limit), args.rate_limit_strikes),
+        handler_timings=HandlerTimings(args.slow_handler_ms / 1000) if args.handler_timing else None,
+        index_page=index_page,
+        load_shedder=LoadShedder(tuple(lag / 1000 for lag in args.shed_lag_ms),
+                                 enabled=not args.no_load_shedding),
+        welcome_messages=args.welcome_messages,
+        bus=bus,
+        node=node,
+        typing_interval=args.typing_interval,
+        typing_ttl=args.typing_ttl
+    )
+    server.restore_history()
+    
+    if history_store is not None:
+        await history_store.start()
+    await bus.start(server.handle_bus_event)
+    await server.start()
+    
+    logger.info(f"Starting WebSocket server on {args.host}:{args.port}")
+    stop = stop_on_sigterm()
+    
+    try:
+        # Start the WebSocket server; with several workers the kernel
+        # spreads incoming connections across them via SO_REUSEPORT
+        async with websockets.serve(
+            server.register_client,
+            args.host,
+            args.port,
+            ping_interval=20,
+            ping_timeout=10,
+            select_subprotocol=select_subprotocol,
+            max_size=MAX_INBOUND_BYTES,
+            process_request=server.process_request,
+            reuse_port=args.workers > 1
+        ):
+            logger.info(f"WebSocket server is running on ws://{args.host}:{args.port}")
+            # Keep the server running until stopped
+            await stop.wait()
+    finally:
+        await server.close()
+        await bus.close()
+        if history_store is not None:
+            await history_store.close()
+
+def run_worker(args, node):
+    """Entry point of a worker process started by run_workers"""
+    try:
+        asyncio.run(main(args, node))
+    except KeyboardInterrupt:
+        pass
+
+async def run_workers(args):
+    """Start one server process per worker and, without Redis, the event bus hub"""
+    hub = None
+    if not args.redis:
+        hub = BusHub(args.bus_path)
+        await hub.start()
+    
+    context = multiprocessing.get_context('spawn')
+    workers = [
+        context.Process(target=run_worker, args=(args, node), name=f"worker-{node}")
+        for node in range(args.node, args.node + args.workers)
+    ]
+    for worker in workers:
+        worker.start()
+    logger.info(f"Started {len(workers)} workers sharing port {args.port}")
+    stop = stop_on_sigterm()
+    
+    try:
+        # Stop everything if a worker dies
+        while not stop.is_set():
+            if not all(worker.is_alive() for worker in workers):
+                logger.error("A worker exited unexpectedly, shutting down")
+                break
+            await asyncio.sleep(1)
+    finally:
+        # Workers flush their history stores on SIGTERM
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
+        if hub is not None:
+            await hub.close()
 
 if __name__ == "__main__":
+    args = parse_args()
     try:
-        asyncio.run(main())
+        if args.workers > 1:
+            asyncio.run(run_workers(args))
+        else:
+            asyncio.run(main(args))
     except KeyboardInterrupt:
         logger.info("Server stopped by user")
     except Exception as e:
@@ -0,0 +1,77 @@
+"""In-memory static file served over the websocket server's HTTP hook
+
+The file is read and compressed once at startup. Each encoding gets its
+own strong ETag, so conditional requests are answered with 304 without
+touching the body.
+"""
+import gzip
+import hashlib
+import mimetypes
+from http import HTTPStatus
+
+from websockets.datastructures import Headers
+from websockets.http11 import Response
+
+try:
+    import brotli
+except ImportError:  # Brotli responses are optional
+    brotli = None
+
+def is_zero_quality(param):
+    """Return True for a q=0 parameter, which marks a coding as not acceptable"""
+    name, _, value = param.partition('=')
+    if name.strip().lower() != 'q':
+        return False
+    try:
+        return float(value) == 0
+    except ValueError:
+        return False
+
+class StaticFile:
+    """One file held in memory in identity, gzip and (if available) brotli encodings"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            body = f.read()
+        self.content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        if self.content_type.startswith('text/'):
+            self.content_type += '; charset=utf-8'
+
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        # (encoding, body, etag), most preferred first
+        self.variants = []
+        if brotli is not None:
+            self.variants.append(('br', brotli.compress(body), f'"{digest}-br"'))
+        self.variants.append(('gzip', gzip.compress(body, mtime=0), f'"{digest}-gz"'))
+        self.variants.append(('identity', body, f'"{digest}"'))
+
+    def choose_variant(self, accept_encoding):
+        """Pick the best encoding the client accepts"""
+        accepted = set()
+        for item in accept_encoding.split(','):
+            coding, *params = item.split(';')
+            if not any(is_zero_quality(param) for param in params):
+                accepted.add(coding.strip().lower())
+        for variant in self.variants:
+            if variant[0] in accepted or '*' in accepted or variant[0] == 'identity':
+                return variant
+
+    def respond(self, request):
+        """Build the response to a GET for this file"""
+        encoding, body, etag = self.choose_variant(request.headers.get('Accept-Encoding', ''))
+        headers = Headers([
+            ('ETag', etag),
+            ('Vary', 'Accept-Encoding'),
+            ('Cache-Control', 'no-cache'),
+        ])
+
+        if_none_match = request.headers.get('If-None-Match', '')
+        if if_none_match.strip() == '*' or etag in (tag.strip() for tag in if_none_match.split(',')):
+            return Response(HTTPStatus.NOT_MODIFIED.value, HTTPStatus.NOT_MODIFIED.phrase,
+                            headers, b'')
+
+        headers['Content-Type'] = self.content_type
+        headers['Content-Length'] = str(len(body))
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        return Response(HTTPStatus.OK.value, HTTPStatus.OK.phrase, headers, body)
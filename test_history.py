@@ -0,0 +1,67 @@
+"""Tests for restoring room histories from the history stores
+
+Run with `python -m unittest test_history` (or pytest).
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import server
+from history import MessageLog, SQLiteHistory
+
+class RestoreTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    async def write_messages(self, store, counts):
+        """Append `count` messages to each room, one room after another"""
+        ids = server.MessageIdGenerator()
+        store.open()
+        await store.start()
+        for room, count in counts:
+            for number in range(count):
+                store.append(server.Frame({
+                    'id': ids.next_id(), 'type': 'message', 'room': room, 'text': f"{room} {number}"
+                }))
+        await store.close()
+
+    def restore(self, store, **options):
+        store.open()
+        self.addAsyncCleanup(store.close)
+        messenger = server.MessengerServer(history_store=store, **options)
+        messenger.restore_history()
+        return messenger
+
+    def texts(self, messenger, room):
+        return [frame.event['text'] for frame in messenger.rooms[room].history]
+
+    async def check_restores_every_room(self, make_store):
+        await self.write_messages(make_store(), [('a', 30), ('b', 10)])
+        messenger = self.restore(make_store(), history_messages=5)
+        self.assertEqual(self.texts(messenger, 'a'), [f"a {number}" for number in range(25, 30)])
+        self.assertEqual(self.texts(messenger, 'b'), [f"b {number}" for number in range(5, 10)])
+
+    async def check_restores_most_recent_rooms(self, make_store):
+        await self.write_messages(make_store(), [('a', 3), ('b', 3), ('c', 3)])
+        messenger = self.restore(make_store(), history_messages=5, max_rooms=2)
+        self.assertEqual(sorted(messenger.rooms), ['b', 'c'])
+        self.assertEqual(len(messenger.rooms['b'].history), 3)
+
+    async def test_message_log_restores_every_room(self):
+        await self.check_restores_every_room(lambda: MessageLog(self.directory))
+
+    async def test_message_log_restores_most_recent_rooms(self):
+        await self.check_restores_most_recent_rooms(lambda: MessageLog(self.directory))
+
+    async def test_sqlite_restores_every_room(self):
+        path = os.path.join(self.directory, 'history.db')
+        await self.check_restores_every_room(lambda: SQLiteHistory(path))
+
+    async def test_sqlite_restores_most_recent_rooms(self):
+        path = os.path.join(self.directory, 'history.db')
+        await self.check_restores_most_recent_rooms(lambda: SQLiteHistory(path))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,215 @@
+"""Tests for the pub/sub backends and cross-node typing state
+
+Run with `python -m unittest test_pubsub` (or pytest). The Redis backend
+is tested against FakeRedis, an in-process server speaking just enough
+RESP for PUBLISH and SUBSCRIBE, so no Redis server is needed.
+"""
+import asyncio
+import unittest
+from unittest import mock
+
+import pubsub
+import server
+from pubsub import InProcessBackend, RedisBackend, read_reply
+
+def bulk(value):
+    return b'$%d\r\n%s\r\n' % (len(value), value)
+
+class FakeRedis:
+    """Local stand-in for a Redis server handling AUTH, SUBSCRIBE and PUBLISH"""
+
+    def __init__(self):
+        self.subscribers = {}
+        self.writers = set()
+        self._server = None
+
+    async def start(self):
+        """Listen on a free local port and return its URL"""
+        self._server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        port = self._server.sockets[0].getsockname()[1]
+        return f"redis://127.0.0.1:{port}"
+
+    async def close(self):
+        self._server.close()
+        self.drop_connections()
+        await self._server.wait_closed()
+
+    def drop_connections(self):
+        """Close every client connection, as a Redis restart would"""
+        for writer in list(self.writers):
+            writer.close()
+
+    def subscriber_count(self, channel):
+        return len(self.subscribers.get(channel.encode(), ()))
+
+    async def _handle(self, reader, writer):
+        self.writers.add(writer)
+        try:
+            while True:
+                command = await read_reply(reader)
+                name = command[0].upper()
+                if name == b'SUBSCRIBE':
+                    self.subscribers.setdefault(command[1], set()).add(writer)
+                    writer.write(b'*3\r\n' + bulk(b'subscribe') + bulk(command[1]) + b':1\r\n')
+                elif name == b'PUBLISH':
+                    targets = self.subscribers.get(command[1], set())
+                    for target in targets:
+                        target.write(
+                            b'*3\r\n' + bulk(b'message') + bulk(command[1]) + bulk(command[2])
+                        )
+                    writer.write(b':%d\r\n' % len(targets))
+                else:
+                    writer.write(b'+OK\r\n')
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.writers.discard(writer)
+            for subscribers in self.subscribers.values():
+                subscribers.discard(writer)
+            writer.close()
+
+class Recorder:
+    """on_event callback collecting (node id, data) pairs"""
+
+    def __init__(self):
+        self.events = []
+        self.received = asyncio.Event()
+
+    async def __call__(self, node_id, data):
+        self.events.append((node_id, data))
+        self.received.set()
+
+    async def next_event(self):
+        await asyncio.wait_for(self.received.wait(), 2)
+        self.received.clear()
+        return self.events[-1]
+
+async def wait_until(condition, timeout=2):
+    """Poll until `condition()` is true"""
+    async def poll():
+        while not condition():
+            await asyncio.sleep(0.01)
+    await asyncio.wait_for(poll(), timeout)
+
+class RedisBackendTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.redis = FakeRedis()
+        url = await self.redis.start()
+        self.events = {'a': Recorder(), 'b': Recorder()}
+        self.nodes = {}
+        for node_id, recorder in self.events.items():
+            self.nodes[node_id] = RedisBackend(url, node_id, 'test')
+            await self.nodes[node_id].start(recorder)
+
+    async def asyncTearDown(self):
+        for node in self.nodes.values():
+            await node.close()
+        await self.redis.close()
+
+    async def test_delivers_to_other_nodes_only(self):
+        self.nodes['a'].publish(b'{"type": "message"}')
+        self.assertEqual(await self.events['b'].next_event(), ('a', b'{"type": "message"}'))
+        # Redis echoes the event back to its publisher, which must skip it
+        self.nodes['b'].publish(b'{"type": "ping"}')
+        self.assertEqual(await self.events['a'].next_event(), ('b', b'{"type": "ping"}'))
+        self.assertEqual(self.events['a'].events, [('b', b'{"type": "ping"}')])
+        self.assertEqual(self.events['b'].events, [('a', b'{"type": "message"}')])
+
+    async def test_nodes_sharing_an_id_still_hear_each_other(self):
+        twin = RedisBackend(f"redis://127.0.0.1:{self.nodes['a'].port}", 'a', 'test')
+        twin_events = Recorder()
+        await twin.start(twin_events)
+        self.addAsyncCleanup(twin.close)
+        with self.assertLogs('pubsub', 'WARNING'):
+            self.nodes['a'].publish(b'x')
+            self.assertEqual(await twin_events.next_event(), ('a', b'x'))
+        twin.publish(b'y')
+        self.assertEqual(await self.events['a'].next_event(), ('a', b'y'))
+        self.assertNotIn(('a', b'x'), self.events['a'].events)
+
+    async def test_reconnects_after_connection_loss(self):
+        with mock.patch.object(pubsub, 'REDIS_RECONNECT_DELAY', 0.05):
+            self.redis.drop_connections()
+            await wait_until(lambda: self.redis.subscriber_count('test') == 0)
+            await wait_until(lambda: self.redis.subscriber_count('test') == 2)
+            await wait_until(lambda: not self.nodes['a']._publisher.is_closing())
+            self.nodes['a'].publish(b'{"type": "message"}')
+            self.assertEqual(await self.events['b'].next_event(), ('a', b'{"type": "message"}'))
+
+    async def test_start_fails_without_redis(self):
+        url = f"redis://127.0.0.1:{self.nodes['a'].port}"
+        await self.redis.close()
+        node = RedisBackend(url, 'c')
+        with self.assertRaises(OSError):
+            await node.start(Recorder())
+        await node.close()
+
+class InProcessBackendTest(unittest.IsolatedAsyncioTestCase):
+    async def test_delivers_to_peers_only(self):
+        peers = []
+        events = {node_id: Recorder() for node_id in 'abc'}
+        nodes = {node_id: InProcessBackend(node_id, peers) for node_id in events}
+        for node_id, node in nodes.items():
+            await node.start(events[node_id])
+
+        nodes['a'].publish(b'x')
+        self.assertEqual(await events['b'].next_event(), ('a', b'x'))
+        self.assertEqual(await events['c'].next_event(), ('a', b'x'))
+        self.assertEqual(events['a'].events, [])
+
+        await nodes['c'].close()
+        nodes['a'].publish(b'y')
+        self.assertEqual(await events['b'].next_event(), ('a', b'y'))
+        await nodes['a'].close()
+        await nodes['b'].close()
+        self.assertEqual(events['c'].events, [('a', b'x')])
+
+    async def test_single_node_publish_does_nothing(self):
+        node = InProcessBackend('a')
+        recorder = Recorder()
+        await node.start(recorder)
+        node.publish(b'x')
+        await asyncio.sleep(0)
+        self.assertEqual(recorder.events, [])
+        await node.close()
+
+class RemoteTypingTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        peers = []
+        self.servers = [
+            server.MessengerServer(bus=InProcessBackend(str(node), peers), node=node,
+                                   typing_interval=0.02, typing_ttl=0.2)
+            for node in range(2)
+        ]
+        for messenger in self.servers:
+            await messenger.bus.start(messenger.handle_bus_event)
+            await messenger.start()
+
+    async def asyncTearDown(self):
+        for messenger in self.servers:
+            await messenger.close()
+            await messenger.bus.close()
+
+    async def test_remote_typing_lasts_while_published_and_expires_after(self):
+        local, remote = self.servers
+        loop = asyncio.get_running_loop()
+        room = local.get_room('general')
+        # A typing user whose local deadline is far away
+        room.add_typing_user('client', 'alice', loop.time() + 60)
+        local.typing_changed.add(room)
+        await wait_until(lambda: 'general' in remote.rooms)
+        remote_room = remote.rooms['general']
+        self.assertEqual(remote_room.get_all_typing_users(), {'alice'})
+
+        # Republished before the remote copy's TTL runs out
+        await asyncio.sleep(0.5)
+        self.assertEqual(remote_room.get_all_typing_users(), {'alice'})
+
+        # The node stops without publishing an empty set
+        await local.close()
+        await local.bus.close()
+        await wait_until(lambda: not remote_room.get_all_typing_users())
+        self.assertNotIn('general', remote.rooms)
+
+if __name__ == '__main__':
+    unittest.main()